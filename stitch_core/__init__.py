@@ -1,7 +1,30 @@
 # import the contents of the Rust library into the Python extension
 from .stitch_core import compress_backend,rewrite_backend
-from typing import Dict, List, Any, Tuple, Union
+from typing import Callable, Dict, Iterable, Iterator, List, Any, Set, Tuple, Union
+from array import array
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from itertools import islice, repeat
+import copy
+import hashlib
 import json
+import math
+import mmap
+import multiprocessing
+import os
+import pickle
+import queue
+import random
+import re
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
 
 class StitchException(Exception):
     """Raised when the Stitch's Rust backend panics"""
@@ -22,7 +45,11 @@ class Abstraction:
     :type body: str
     :param arity: the arity of the abstraction, like 2
     :type arity: int
+
+    Abstractions are equal if all of their fields are, and can be used as dict keys or in sets (so they shouldn't be modified once they are).
     """
+    __slots__ = ("name", "body", "arity", "tdfa_annotation")
+
     def __init__(self, name: str, body: str, arity: int, tdfa_annotation: Union[str,None] = None):
         self.name = name
         self.body = body
@@ -34,6 +61,18 @@ class Abstraction:
         args = ','.join([f'#{i}' for i in range(self.arity)])
         return f"{self.name}({args}) := {self.body}"
 
+    def __eq__(self, other):
+        if not isinstance(other, Abstraction):
+            return NotImplemented
+        return (self.name, self.body, self.arity, self.tdfa_annotation) == (other.name, other.body, other.arity, other.tdfa_annotation)
+
+    def __hash__(self):
+        # tdfa_annotation is left out since it can be a dict, and equal abstractions still hash the same without it
+        return hash((self.name, self.body, self.arity))
+
+    def __reduce__(self):
+        return (Abstraction, (self.name, self.body, self.arity, self.tdfa_annotation))
+
     @staticmethod
     def from_dreamcoder(name:str, dreamcoder_abstraction: str, name_mapping: List[Tuple[str,str]]):
         """
@@ -59,16 +98,68 @@ class CompressionResult:
 
     :param abstractions: a list of Abstraction objects
     :type abstractions: List[Abstraction]
-    :param rewritten: a list of programs, where each program has been rewritten using the abstractions
+    :param rewritten: a list of programs, where each program has been rewritten using the abstractions (None if compress() was called with ``outputs`` that leave it out)
     :type rewritten: List[str]
     :param json: the raw JSON output from the Rust backend, containing lots of additional information
     :type json: Dict[str,Any]
+
+    Results are pickled in the compact binary format of save() (see result_from_binary()), so they are cheap to send between processes.
     """
+    __slots__ = ("abstractions", "rewritten", "json")
+
     def __init__(self, json: Dict[str,Any]):
         self.abstractions: List[Abstraction] = [Abstraction(body=abs["body"], name=abs["name"], arity=abs["arity"], tdfa_annotation=abs["tdfa_annotation"]) for abs in json["abstractions"]]
-        self.rewritten: List[str] = json['rewritten']
+        self.rewritten: Union[List[str],None] = json.get('rewritten')
         self.json = json
 
+    def save(self, path: Union[str,os.PathLike], format: str = "binary"):
+        """
+        Saves ``.json`` to a file, in the compact binary format by default or as indented json with ``format="json"`` (see save_data()).
+        CompressionResult.load() gives back a result with exactly the same ``.json``.
+        """
+        save_data(self.json, path, format)
+
+    @staticmethod
+    def load(path: Union[str,os.PathLike], use_mmap: bool = False) -> "CompressionResult":
+        """
+        Loads a result saved with save() in either format, optionally memory-mapping it (see load_data())
+        """
+        return CompressionResult(load_data(path, use_mmap))
+
+    def __reduce__(self):
+        return (result_from_binary, (CompressionResult, encode_binary(self.json, PICKLE_COMPRESSION_LEVEL)))
+
+    @property
+    def candidates(self) -> List[List[Dict[str,Any]]]:
+        """
+        When compress() was called with ``return_candidates=k``, this is a list with an entry for each iteration holding the top-k
+        candidate abstractions that the search scored on that iteration, best first. Each candidate is a dictionary with
+        the keys ``rank``, ``name``, ``body``, ``arity``, ``utility``, ``final_cost``, ``compression_ratio``, and ``num_uses``,
+        which have the same meaning as in ``.json["abstractions"]`` (see :ref:`out-json`).
+        """
+        assert "candidates" in self.json, "pass return_candidates=k to compress() to get candidates"
+        return self.json["candidates"]
+
+    @property
+    def stats(self) -> Dict[str,Any]:
+        """
+        Timing and memory telemetry for the compress() call that produced this result (also stored in ``.json["stats"]``).
+        Times are in seconds, split into the following phases:
+
+         - ``args_secs``: building the arguments for the Rust backend in Python
+         - ``backend_secs``: the call into the Rust backend, which converts the arguments, parses the programs, runs the search and rewriting for each iteration, and serializes the output json
+         - ``json_decode_secs``: decoding the output json in Python
+         - ``postprocess_secs``: building this result object in Python
+         - ``total_secs``: the whole call
+         - ``peak_rss_mb``: the peak resident memory of the process so far in megabytes (None on platforms without the ``resource`` module)
+
+        If compress() was called with ``detailed_stats=True`` there is also an ``iterations`` list with an entry for each iteration
+        breaking down the backend's time in milliseconds (``prep_ms``, ``search_ms``, ``postprocess_ms``) along with the search's
+        worklist and pruning counters (``worklist_steps``, ``upper_bound_fired``, ``useless_abstract_fired``, etc.), and a ``backend_ms``
+        total as measured by the backend.
+        """
+        return self.json["stats"]
+
 class RewriteResult:
     """
     The result of calling rewrite().
@@ -77,11 +168,92 @@ class RewriteResult:
     :type rewritten: List[str]
     :param json: the raw JSON output from the Rust backend, containing lots of additional information
     :type json: Dict[str,Any]
+
+    Like CompressionResult, results are pickled in the compact binary format.
     """
+    __slots__ = ("rewritten", "json")
+
     def __init__(self, json: Dict[str,Any]):
-        self.rewritten: List[str] = json['rewritten']
+        self.rewritten: Union[List[str],None] = json.get('rewritten')
         self.json = json
 
+    def save(self, path: Union[str,os.PathLike], format: str = "binary"):
+        """
+        Saves ``.json`` to a file, see CompressionResult.save()
+        """
+        save_data(self.json, path, format)
+
+    @staticmethod
+    def load(path: Union[str,os.PathLike], use_mmap: bool = False) -> "RewriteResult":
+        """
+        Loads a result saved with save(), see CompressionResult.load()
+        """
+        return RewriteResult(load_data(path, use_mmap))
+
+    def __reduce__(self):
+        return (result_from_binary, (RewriteResult, encode_binary(self.json, PICKLE_COMPRESSION_LEVEL)))
+
+    @property
+    def stats(self) -> Dict[str,Any]:
+        """
+        Timing and memory telemetry for the rewrite() call that produced this result, see CompressionResult.stats
+        """
+        return self.json["stats"]
+
+class VerifyResult:
+    """
+    The result of calling verify().
+
+    :param num_programs: the number of programs that were checked
+    :type num_programs: int
+    :param mismatches: an ``(index, original, expanded)`` tuple for each program whose rewritten form did not expand back into the original
+    :type mismatches: List[Tuple[int,str,str]]
+    """
+    def __init__(self, num_programs: int, mismatches: List[Tuple[int,str,str]]):
+        self.num_programs = num_programs
+        self.mismatches = mismatches
+
+    @property
+    def ok(self) -> bool:
+        """True if every program round-tripped"""
+        return len(self.mismatches) == 0
+
+    def __repr__(self):
+        return f"VerifyResult({self.num_programs - len(self.mismatches)}/{self.num_programs} programs match)"
+
+class MergeResult:
+    """
+    The result of calling merge_libraries().
+
+    :param abstractions: the merged library, renamed to ``fn_0``, ``fn_1``, etc. and ordered so that abstractions come after any abstractions they call
+    :type abstractions: List[Abstraction]
+    :param renames: for each input library, a dictionary from the old name of each abstraction to its name in the merged library
+    :type renames: List[Dict[str,str]]
+    :param num_duplicates: the number of input abstractions that were dropped as duplicates of an earlier abstraction
+    :type num_duplicates: int
+    :param rewrite_result: the result of rewriting the ``programs`` passed to merge_libraries() with the merged library, or None if no programs were passed
+    :type rewrite_result: Union[RewriteResult,None]
+    """
+    def __init__(self, abstractions: List[Abstraction], redirects: List[Dict[str,Tuple[str,int,List[int]]]], num_duplicates: int, rewrite_result: Union[RewriteResult,None]):
+        self.abstractions = abstractions
+        self.redirects = redirects
+        self.renames: List[Dict[str,str]] = [{old: new for (old, (new, _, _)) in redirect.items()} for redirect in redirects]
+        self.num_duplicates = num_duplicates
+        self.rewrite_result = rewrite_result
+
+    @property
+    def utilities(self) -> Dict[str,int]:
+        """The utility of each abstraction in the merged library on the ``programs`` passed to merge_libraries()"""
+        assert self.rewrite_result is not None, "merge_libraries() was not given any programs to score the merged library on"
+        return {a["name"]: a["utility"] for a in self.rewrite_result.json["abstractions"]}
+
+    def translate(self, programs: List[str], library_index: int) -> List[str]:
+        """
+        Translates programs that were rewritten with the input library at ``library_index`` into programs that use the merged library,
+        renaming abstractions and reordering their arguments where a duplicate took its arguments in a different order.
+        """
+        return [show_sexpr(sexpr_redirect(parse(p), self.redirects[library_index])) for p in programs]
+
 def from_dreamcoder(json: Dict[str,Any]) -> Dict[str,Any]:
     """
     Takes a dreamcoder-style json dictionary and returns a dictionary of arguments to pass as kwargs to compress() or rewrite().
@@ -204,9 +376,218 @@ def replace_prim(program: str, prim: str, new: str) -> str:
     assert f"{prim}" != program # case where entire program is just the primitive
     return program
 
+def bulk_list(source: Any, convert: Union[Callable[[str],Any],None] = None) -> Union[List[Any],None]:
+    """
+    Turns a bulk input into the list that the backend takes. A newline-delimited ``bytes``, ``bytearray`` or ``memoryview`` buffer, or an ``os.PathLike``
+    path to a newline-delimited utf-8 file, is decoded in one pass and split into one entry per line, passing each through ``convert`` if given (eg
+    float for weights). This is a convenience for loading inputs, not a way to save memory: the whole file is read in and the lines are separate
+    strings, just as if it had been read and split by hand. A NumPy array, or anything else with a ``tolist()`` method, is converted with that in one
+    pass instead of element by element. Anything else, including lists and None, is returned as is.
+
+    A plain ``str`` isn't treated as a path, since a single program is also a string.
+
+    :param source: The programs, tasks, or weights in any of the forms above.
+    :type source: Any
+    :param convert: What to apply to each line of a buffer or file.
+    :type convert: Callable[[str],Any]
+    :return: A list with one entry per program, or ``source`` itself if it isn't a bulk input.
+    :rtype: Union[List[Any],None]
+    """
+    if isinstance(source, os.PathLike):
+        with open(source, "rb") as f:
+            text = str(f.read(), "utf-8")
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        text = str(source, "utf-8")
+    elif hasattr(source, "tolist"):
+        return source.tolist()
+    else:
+        return source
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop() # trailing newline
+    lines = [line[:-1] if line.endswith("\r") else line for line in lines] if "\r" in text else lines
+    return lines if convert is None else [convert(line) for line in lines]
+
+def task_list(tasks: List[Union[str,int]], task_names: Union[List[str],Dict[int,str],None] = None) -> List[str]:
+    """
+    The task name of each program, from either a list of names or a list of integer task ids. Ids are looked up in ``task_names`` (a list
+    indexed by id, or a dict from id to name) if it's given, and otherwise each id is its own name. Each distinct name is only built
+    once and then shared by all of the programs of that task.
+
+    :param tasks: The task of each program, as a name or an id.
+    :type tasks: List[Union[str,int]]
+    :param task_names: The name of each task id.
+    :type task_names: Union[List[str],Dict[int,str]]
+    :return: The task name of each program.
+    :rtype: List[str]
+    """
+    if len(tasks) == 0 or isinstance(tasks[0], str):
+        assert task_names is None, "task_names can only be used with integer task ids"
+        return tasks
+    names = {i: str(i) for i in set(tasks)} if task_names is None else task_names
+    if not isinstance(names, dict) and not 0 <= min(tasks) <= max(tasks) < len(names):
+        # checked up front since a negative id would otherwise index task_names from the end
+        missing = next(i for i in tasks if not 0 <= i < len(names))
+        raise ValueError(f"task id {missing} is missing from task_names")
+    try:
+        return [names[i] for i in tasks]
+    except KeyError:
+        missing = next(i for i in tasks if i not in names)
+        raise ValueError(f"task id {missing} is missing from task_names") from None
+
+# the compress() kwargs that a TdfaGrammar sets
+TDFA_KWARGS = ("tdfa_json_path", "tdfa_root", "valid_roots", "valid_metavars", "tdfa_non_eta_long_states", "tdfa_split")
+# where each distinct grammar is written for the backend to read, named by its content hash. It's private to the user (see tdfa_cache_dir())
+TDFA_CACHE_DIR = os.path.join(tempfile.gettempdir(), f"stitch_core_tdfa_{os.getuid()}" if hasattr(os, "getuid") else "stitch_core_tdfa")
+# each TdfaGrammar made by from_dict() or load() by content hash, and each file read by load() by path, modification time and size. Only the
+# most recent TDFA_CACHE_SIZE of each are kept (see TdfaGrammar.clear_cache() to empty them)
+TDFA_GRAMMARS: Dict[str,"TdfaGrammar"] = {}
+TDFA_FILES: Dict[Tuple[str,int,int],Dict[str,Any]] = {}
+TDFA_CACHE_SIZE = 32
+
+def cache_put(cache: Dict[Any,Any], key: Any, value: Any):
+    """Adds an entry to one of the TDFA caches, dropping the oldest entries past TDFA_CACHE_SIZE"""
+    cache[key] = value
+    while len(cache) > TDFA_CACHE_SIZE:
+        del cache[next(iter(cache))]
+
+class TdfaGrammar:
+    """
+    A type grammar, in the form of a tree deterministic finite automaton (TDFA), that restricts compress() to abstractions that are well-typed
+    under it. Pass it to compress() as ``tdfa=`` instead of the ``tdfa_json_path``, ``tdfa_root``, ``valid_roots``, ``valid_metavars``,
+    ``tdfa_non_eta_long_states`` and ``tdfa_split`` arguments, and each learned abstraction is annotated with the states of its root and
+    of its arguments in ``tdfa_annotation``.
+
+    Grammars made with from_dict() or load() are cached by a hash of their contents, so calling compress() in a loop with the same grammar
+    (eg across DreamCoder iterations) reuses one object rather than re-reading and re-checking it on every call. The backend only reads
+    grammars from files, so each distinct grammar is written once to a file in TDFA_CACHE_DIR (a directory private to the user) named by its
+    hash, and every call points the backend at that file after checking that it still holds the grammar.
+
+    A grammar keeps its own copy of ``tdfa``, so changing the dict afterwards doesn't change the grammar.
+
+    :param tdfa: maps each state to the symbols that can appear in it, and each symbol to the states of its arguments, like ``{"S": {"f": ["T", "T"]}, "T": {"g": ["T", "T"], "a": []}}``
+    :type tdfa: Dict[str,Dict[str,List[str]]]
+    :param root: the state of the root of each program
+    :type root: str
+    :param valid_roots: the states that an abstraction's body may be in
+    :type valid_roots: List[str]
+    :param valid_metavars: the states that an abstraction's arguments may be in
+    :type valid_metavars: List[str]
+    :param non_eta_long_states: the states that are not in eta-long form, mapped to the states that their partial applications are in
+    :type non_eta_long_states: Dict[str,Any]
+    :param split: if given, only the part of each symbol before ``split`` is looked up in the grammar
+    :type split: str
+    """
+    def __init__(self, tdfa: Dict[str,Dict[str,List[str]]], root: str, valid_roots: List[str], valid_metavars: List[str],
+                 non_eta_long_states: Union[Dict[str,Any],None] = None, split: Union[str,None] = None):
+        states = set(tdfa) | {state for symbols in tdfa.values() for args in symbols.values() for state in args}
+        if root not in tdfa:
+            raise ValueError(f"the root state {root!r} isn't in the grammar")
+        for name, given in (("valid_roots", valid_roots), ("valid_metavars", valid_metavars), ("non_eta_long_states", non_eta_long_states or {})):
+            unknown = set(given) - states
+            if unknown:
+                raise ValueError(f"{name} has states that aren't in the grammar: {sorted(unknown)}")
+        self.tdfa = copy.deepcopy(tdfa)
+        self.root = root
+        self.valid_roots = list(valid_roots)
+        self.valid_metavars = list(valid_metavars)
+        self.non_eta_long_states = dict(non_eta_long_states or {})
+        self.split = split
+        self.key = TdfaGrammar.hash(tdfa, root, valid_roots, valid_metavars, non_eta_long_states, split)
+        contents = self.file_contents()
+        self.file_size = len(contents)
+        self.file_hash = hashlib.sha256(contents).hexdigest()
+
+    @staticmethod
+    def hash(*contents) -> str:
+        """The content hash that grammars are cached by"""
+        return hashlib.sha256(json.dumps(contents, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+    @staticmethod
+    def from_dict(tdfa: Dict[str,Dict[str,List[str]]], root: str, valid_roots: List[str], valid_metavars: List[str],
+                  non_eta_long_states: Union[Dict[str,Any],None] = None, split: Union[str,None] = None) -> "TdfaGrammar":
+        """
+        Makes a grammar from an in-memory TDFA, returning the cached grammar if one with the same contents was made before. See TdfaGrammar for the arguments.
+        """
+        key = TdfaGrammar.hash(tdfa, root, valid_roots, valid_metavars, non_eta_long_states, split)
+        if key not in TDFA_GRAMMARS:
+            cache_put(TDFA_GRAMMARS, key, TdfaGrammar(tdfa, root, valid_roots, valid_metavars, non_eta_long_states, split))
+        return TDFA_GRAMMARS[key]
+
+    @staticmethod
+    def load(path: Union[str,os.PathLike], root: str, valid_roots: List[str], valid_metavars: List[str],
+             non_eta_long_states: Union[Dict[str,Any],None] = None, split: Union[str,None] = None) -> "TdfaGrammar":
+        """
+        Makes a grammar from a TDFA json file, like from_dict(). The file is only read again if it has changed since it was last loaded.
+        """
+        st = os.stat(path)
+        file_key = (os.path.realpath(path), st.st_mtime_ns, st.st_size)
+        if file_key not in TDFA_FILES:
+            with open(path) as f:
+                cache_put(TDFA_FILES, file_key, json.load(f))
+        return TdfaGrammar.from_dict(TDFA_FILES[file_key], root, valid_roots, valid_metavars, non_eta_long_states, split)
+
+    @staticmethod
+    def clear_cache():
+        """
+        Forgets the grammars made by from_dict() and load() and the files read by load(), so that their memory can be freed. The grammar files in TDFA_CACHE_DIR are kept.
+        """
+        TDFA_GRAMMARS.clear()
+        TDFA_FILES.clear()
+
+    def file_contents(self) -> bytes:
+        """The contents of the file that the backend reads this grammar from"""
+        return json.dumps(self.tdfa, separators=(",", ":")).encode()
+
+    def compress_kwargs(self) -> Dict[str,Any]:
+        """
+        The backend arguments for this grammar, writing it out to its file in TDFA_CACHE_DIR if needed. The file is checked on every call
+        (its size, then its hash) and rewritten if it doesn't hold this grammar, say because it was deleted or changed since the last call.
+        """
+        directory = tdfa_cache_dir()
+        path = os.path.join(directory, f"{self.file_hash}.json")
+        try:
+            with open(path, "rb") as f:
+                ok = os.fstat(f.fileno()).st_size == self.file_size and hashlib.sha256(f.read()).hexdigest() == self.file_hash
+        except OSError:
+            ok = False
+        if not ok:
+            # written under a temporary name first so that other processes never see half of the file
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.file_contents())
+            os.replace(tmp, path)
+        # the backend splits its arguments on whitespace, so these have to be compact
+        kwargs = dict(
+            tdfa_json_path=path,
+            tdfa_root=self.root,
+            valid_roots=json.dumps(self.valid_roots, separators=(",", ":")),
+            valid_metavars=json.dumps(self.valid_metavars, separators=(",", ":")),
+            tdfa_non_eta_long_states=json.dumps(self.non_eta_long_states, separators=(",", ":")),
+        )
+        if self.split is not None:
+            kwargs["tdfa_split"] = self.split
+        return kwargs
+
+    def __repr__(self):
+        return f"TdfaGrammar(root={self.root!r}, states={len(self.tdfa)}, key={self.key[:12]})"
+
+def tdfa_cache_dir() -> str:
+    """
+    Creates TDFA_CACHE_DIR if needed, and checks that it's a directory that only the current user can write to, since compress() trusts the grammar files in it
+    """
+    os.makedirs(TDFA_CACHE_DIR, mode=0o700, exist_ok=True)
+    if hasattr(os, "getuid"):
+        st = os.lstat(TDFA_CACHE_DIR)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o022:
+            raise PermissionError(f"{TDFA_CACHE_DIR} isn't a directory that only this user can write to, so grammar files can't be cached there "
+                                  "(set stitch_core.TDFA_CACHE_DIR to use another directory)")
+    return TDFA_CACHE_DIR
+
 def rewrite(
-    programs: List[str],
+    programs: Union[List[str],bytes,memoryview,os.PathLike],
     abstractions: List[Abstraction],
+    outputs: Union[Set[str],List[str],None] = None,
     **kwargs
     ) -> RewriteResult:
     """
@@ -214,9 +595,12 @@ def rewrite(
     then abstractions[1], etc. Will not perform a rewrite if it is not compressive.
 
     :param programs: A list of programs to rewrite in stitch format. See dreamcoder_to_stitch() or from_dreamcoder() for translating to this format from dreamcoder.
-    :type programs: List[str]
+        Can also be a newline-delimited buffer or file path, see compress().
+    :type programs: Union[List[str],bytes,memoryview,os.PathLike]
     :param abstractions: A list of Abstraction objects to rewrite with.
     :type abstractions: List[Abstraction]
+    :param outputs: If given, only keep these sections of the output json, see compress().
+    :type outputs: Union[Set[str],List[str]]
     :param \**kwargs: Additional arguments to pass to the Rust backend. Only the following cost-related arguments from :ref:`compress_kwargs` can be used: ``cost_app``, ``cost_ivar``, ``cost_lam``, ``cost_prim_default``, and ``cost_var``.
     :raises StitchException: If the Rust backend panics.
     :raises TypeError: If the wrong types are provided for arguments.
@@ -224,13 +608,21 @@ def rewrite(
     :rtype: RewriteResult
     """
 
+    programs = bulk_list(programs)
+    if outputs is not None:
+        outputs = set(outputs)
+        assert outputs <= set(OUTPUTS), f"unknown outputs {outputs - set(OUTPUTS)}, the options are {OUTPUTS}"
+
     # pop these just so we're compatible with all the same kwargs as compress
     kwargs.pop("tasks", None)
+    kwargs.pop("task_names", None)
     kwargs.pop("name_mapping", None)
 
     panic_loud = kwargs.pop('panic_loud',False)
 
+    timer = Timer()
     args = " ".join([build_arg(k, v) for k, v in kwargs.items()])
+    timer.lap("args_secs")
 
     try:
         (rewritten,json_res) = rewrite_backend(
@@ -239,7 +631,9 @@ def rewrite(
             panic_loud,
             args
         )
+        timer.lap("backend_secs")
         json_res = json.loads(json_res)
+        timer.lap("json_decode_secs")
         assert json_res["rewritten"] == rewritten
 
         # since we have no way to pass a name_mapping to the backend, these results will be
@@ -247,8 +641,13 @@ def rewrite(
         json_res.pop("rewritten_dreamcoder")
         for a in json_res["abstractions"]:
             a.pop("rewritten_dreamcoder")
+        if outputs is not None:
+            drop_outputs(json_res, outputs)
 
-        return RewriteResult(json_res)
+        json_res["stats"] = timer.stats
+        res = RewriteResult(json_res)
+        timer.finish()
+        return res
     except BaseException as e:
         if e.__class__.__name__ == "PanicException":
             raise StitchException(f"Rust backend panicked with exception: {e}")
@@ -257,11 +656,24 @@ def rewrite(
 
 
 def compress(
-    programs: List[str],
+    programs: Union[List[str],bytes,memoryview,os.PathLike],
     iterations: int,
     max_arity: int = 2,
     threads: int = 1,
     silent: bool = True,
+    return_candidates: int = 0,
+    detailed_stats: bool = False,
+    on_event: Union[Callable[[List[Dict[str,Any]]],None],None] = None,
+    autotune: Union[bool,str] = False,
+    sample: Union[int,float,None] = None,
+    sample_by: str = "task",
+    sample_seed: int = 0,
+    min_utility: Union[float,None] = None,
+    min_ratio_gain: Union[float,None] = None,
+    max_secs: Union[float,None] = None,
+    max_memory_mb: Union[float,None] = None,
+    outputs: Union[Set[str],List[str],None] = None,
+    tdfa: Union[TdfaGrammar,None] = None,
     **kwargs
     ) -> CompressionResult:
     """
@@ -272,8 +684,15 @@ def compress(
 
     Learned abstractions can call earlier abstractions that were learned, thus building up a hierarchy of increasingly complex abstractions.
 
+    ``return_candidates``, ``detailed_stats`` and ``on_event`` work by capturing the backend's printouts from the stdout file descriptor, which is
+    shared by the whole process. For the length of such a call, anything else written straight to that file descriptor (rather than through
+    ``sys.stdout``, which keeps working) is captured and not shown, and other calls that capture or print (``silent=False``) wait for it to finish.
+
     :param programs: A list of programs to learn abstractions from in stitch format. See dreamcoder_to_stitch() or from_dreamcoder() for translating to this format from dreamcoder.
-    :type programs: List[str]
+        For large corpora this can also be a newline-delimited ``bytes`` or ``memoryview`` buffer with one program per line, or the ``os.PathLike`` path
+        (eg a ``pathlib.Path``) of such a file. The ``tasks`` and ``weights`` kwargs can be given the same ways or as NumPy arrays (see bulk_list()),
+        and ``tasks`` can also be integer task ids, named by an optional ``task_names`` kwarg that lists or maps the name of each id (see task_list()).
+    :type programs: Union[List[str],bytes,memoryview,os.PathLike]
     :param iterations: The maximum number of iterations to run abstraction learning for.
     :type iterations: int
     :param max_arity: The maximum arity of abstractions to learn.
@@ -282,18 +701,103 @@ def compress(
     :type threads: int
     :param silent: Whether to print progress to stdout.
     :type silent: bool
+    :param return_candidates: If nonzero, keep the top ``return_candidates`` abstractions that the search scored on each iteration (the winner
+        plus runners-up) and return them in ``.candidates``. This sets ``inv_candidates`` in the backend.
+    :type return_candidates: int
+    :param detailed_stats: If True, break down the time of each iteration in ``.stats`` and include the search's worklist and pruning counters (see CompressionResult.stats).
+    :type detailed_stats: bool
+    :param on_event: If given, this is called with lists of progress events while the search runs (see :ref:`compress_events`).
+        Events are batched so that the callback runs at most once every 0.2 seconds plus once at the end of each iteration, from a
+        background thread, and the backend isn't asked to print the extra progress that events come from unless ``on_event`` is given. An exception raised by the callback stops further events and is re-raised once the backend returns.
+    :type on_event: Callable[[List[Dict[str,Any]]],None]
+    :param autotune: If True, choose ``threads``, ``batch`` and ``dynamic_batch`` from the size of the corpus, the spread of its program sizes, and the number of cores
+        (overriding any values passed for them). If "calibrate", also time a few candidate settings on one iteration over a sample of the corpus and keep the fastest.
+        The chosen settings are used like any others and so show up in ``.json["args"]["step"]``, and ``.json["args"]["autotune"]`` records the corpus
+        statistics they were chosen from (see autotune_settings()).
+    :type autotune: Union[bool,str]
+    :param sample: If given, search for abstractions on a random sample of the programs instead of all of them, then rewrite the full corpus with the abstractions
+        that were found. An int is the number of programs to sample and a float is the fraction of programs. The result describes the full corpus, with
+        the compression on the sample in ``.json["sample"]`` (see :ref:`out-json`).
+    :type sample: Union[int,float]
+    :param sample_by: How to draw the ``sample``: "task" samples the same fraction of the programs of each task, so that every task is represented in
+        proportion to its size (tasks too small for even one program are included at random with that probability), while "program" samples programs uniformly.
+        These are the same if no ``tasks`` are given.
+    :type sample_by: str
+    :param sample_seed: The random seed for drawing the ``sample``.
+    :type sample_seed: int
+    :param min_utility: If given, stop once an iteration's abstraction has a utility below this, without keeping that abstraction.
+    :type min_utility: float
+    :param min_ratio_gain: If given, stop once an iteration's abstraction would raise the ``cumulative_compression_ratio`` by less than this fraction
+        (so 0.01 is 1%) of its previous value, without keeping that abstraction.
+    :type min_ratio_gain: float
+    :param max_secs: If given, don't start another iteration once this many seconds have passed. The iteration that is running when the time runs out is allowed to finish.
+    :type max_secs: float
+    :param max_memory_mb: If given, keep the memory used by the search and rewriting under this many megabytes. Most of the memory goes to indexing
+        where each pattern matches in the corpus, which grows faster than the corpus does, so if the search gets near the cap it is retried single-threaded
+        on a sample of half as many programs as in ``sample`` (repeatedly if needed), and the full corpus is then rewritten in chunks. The search runs in a
+        child process so that it can be stopped without losing this process, and ``on_event`` can't be used. ``.json["memory"]`` records the peak memory
+        and whether the cap ``limited`` the search to a sample, in which case it may have found different abstractions than it would have without the cap.
+    :type max_memory_mb: float
+    :param outputs: If given, only these sections of the output json are kept, out of ``"abstractions"`` (which is always kept), ``"rewritten"``,
+        ``"original"``, ``"rewritten_dreamcoder"``, ``"uses"`` (of each abstraction) and ``"intermediates"`` (the ``rewritten`` and ``rewritten_dreamcoder``
+        of each abstraction), along with the costs, ratios, args and stats which are small. ``"rewritten_dreamcoder"`` and ``"intermediates"`` are only
+        computed if they are selected, regardless of the ``rewritten_dreamcoder`` and ``rewritten_intermediates`` arguments, and the others are dropped as soon as
+        the backend's output is decoded so that they aren't kept in memory. ``.rewritten`` is None unless ``"rewritten"`` is selected.
+    :type outputs: Union[Set[str],List[str]]
+    :param tdfa: If given, only learn abstractions that are well-typed under this grammar, see TdfaGrammar. This takes the place of the
+        ``tdfa_json_path``, ``tdfa_root``, ``valid_roots``, ``valid_metavars``, ``tdfa_non_eta_long_states`` and ``tdfa_split`` arguments.
+    :type tdfa: TdfaGrammar
     :param \**kwargs: Additional arguments to pass to the Rust backend. See :ref:`compress_kwargs` for a full listing.
     :raises StitchException: If the Rust backend panics.
     :raises TypeError: If the wrong types are provided for arguments.
     :return: A CompressionResult object containing the learned abstractions, rewritten programs, and other details from the run.
+        ``.json["stop_reason"]`` says why compression stopped (see :ref:`out-json`).
     :rtype: CompressionResult
     """
 
+    programs = bulk_list(programs)
+    for key, convert in (("tasks", None), ("weights", float)):
+        if key in kwargs:
+            kwargs[key] = bulk_list(kwargs[key], convert)
+    task_names = kwargs.pop("task_names", None)
+    if kwargs.get("tasks") is not None:
+        kwargs["tasks"] = task_list(kwargs["tasks"], task_names)
+    else:
+        assert task_names is None, "task_names was given without any tasks"
+    if tdfa is not None:
+        assert not any(k in kwargs for k in TDFA_KWARGS), f"pass either tdfa or the {TDFA_KWARGS} arguments, not both"
+        kwargs.update(tdfa.compress_kwargs())
+
+    if outputs is not None:
+        outputs = set(outputs)
+        assert outputs <= set(OUTPUTS), f"unknown outputs {outputs - set(OUTPUTS)}, the options are {OUTPUTS}"
+        # the backend only builds these when asked to
+        kwargs.update(rewritten_dreamcoder="rewritten_dreamcoder" in outputs, rewritten_intermediates="intermediates" in outputs)
+
+    stopping = dict(min_utility=min_utility, min_ratio_gain=min_ratio_gain, max_secs=max_secs)
+    if max_memory_mb is not None:
+        return select_outputs(compress_bounded(programs, iterations, max_memory_mb, sample, sample_by, sample_seed, max_arity=max_arity, threads=threads, silent=silent,
+                              return_candidates=return_candidates, detailed_stats=detailed_stats, on_event=on_event, autotune=autotune, **stopping, **kwargs), outputs)
+    if sample is not None:
+        return select_outputs(compress_sample(programs, iterations, sample, sample_by, sample_seed, max_arity=max_arity, threads=threads, silent=silent,
+                              return_candidates=return_candidates, detailed_stats=detailed_stats, on_event=on_event, autotune=autotune, **stopping, **kwargs), outputs)
+    if any(v is not None for v in stopping.values()):
+        # the criteria are checked between iterations, so run the iterations one at a time
+        return select_outputs(compress_stepwise(programs, iterations, max_arity=max_arity, threads=threads, silent=silent, return_candidates=return_candidates,
+                              detailed_stats=detailed_stats, on_event=on_event, autotune=autotune, **stopping, **kwargs), outputs)
+
     tasks = kwargs.pop("tasks", None)
     weights = kwargs.pop("weights", None)
     name_mapping = kwargs.pop("name_mapping", None)
     panic_loud = kwargs.pop('panic_loud',False)
 
+    tuned = None
+    if autotune:
+        assert autotune in (True, "calibrate"), f"autotune must be True, False, or \"calibrate\", not {autotune!r}"
+        tuned = autotune_settings(programs, tasks, weights, max_arity, calibrate=autotune == "calibrate", **kwargs)
+        threads = tuned["threads"]
+        kwargs.update(batch=tuned["batch"], dynamic_batch=tuned["dynamic_batch"])
+
     kwargs.update(dict(
         iterations=iterations,
         max_arity=max_arity,
@@ -301,27 +805,1527 @@ def compress(
         silent=silent
     ))
 
+    # the backend only reports the runners-up and the per-iteration stats in its step printouts, so we turn those on and capture them
+    capture = bool(return_candidates) or detailed_stats or on_event is not None
+    if capture:
+        kwargs.update(silent=False)
+    if return_candidates:
+        kwargs.update(inv_candidates=return_candidates)
+    events = None
+    if on_event is not None:
+        # new bests and periodic search counters are only printed with these on, so leave them off unless someone's listening
+        kwargs.setdefault("verbose_best", True)
+        kwargs.setdefault("print_stats", EVENT_STATS_EVERY)
+        events = EventStream(on_event)
+
+    timer = Timer()
     args = " ".join([build_arg(k, v) for k, v in kwargs.items()])
+    timer.lap("args_secs")
 
     try:
-        res = compress_backend(
-            programs,
-            tasks,
-            weights,
-            name_mapping,
-            panic_loud,
-            args)
+        with capture_stdout(enabled=capture, on_line=events and events.line, exclusive=not silent) as captured:
+            res = compress_backend(
+                programs,
+                tasks,
+                weights,
+                name_mapping,
+                panic_loud,
+                args)
     except BaseException as e:
+        if events is not None:
+            events.stop()
         if e.__class__.__name__ == "PanicException":
             raise StitchException(f"Rust backend panicked with exception: {e}")
         else:
             raise # eg TypeError from pyo3 conversion
     
+    timer.lap("backend_secs")
+    if events is not None:
+        events.finish()
     res = json.loads(res)
-    
+    if outputs is not None:
+        drop_outputs(res, outputs)
+    timer.lap("json_decode_secs")
+
+    if capture and not silent:
+        sys.stdout.write(captured.text)
+    if return_candidates:
+        res["candidates"] = parse_candidates(captured.text)
+    if tuned is not None:
+        res["args"]["autotune"] = tuned
+    res["stop_reason"] = "iterations" if res["num_abstractions"] == iterations else "no_compressive_abstraction"
+    res["stats"] = timer.stats
+    if detailed_stats:
+        res["stats"].update(parse_step_stats(captured.text))
+
+    res = CompressionResult(res)
+    timer.finish()
+    return res
+
+def compress_stepwise(
+    programs: List[str],
+    iterations: int,
+    min_utility: Union[float,None],
+    min_ratio_gain: Union[float,None],
+    max_secs: Union[float,None],
+    **kwargs
+    ) -> CompressionResult:
+    """
+    Runs compress() with stopping criteria, as a series of single-iteration calls that each continue from the programs rewritten by the
+    last one, checking the criteria in between. This learns the same abstractions as one call with the same ``iterations``.
+    """
+    start = time.perf_counter()
+    on_event = kwargs.pop("on_event", None)
+    name_mapping = list(kwargs.pop("name_mapping", None) or [])
+    previous_abstractions = kwargs.pop("previous_abstractions", 0)
+    res = None
+    abstractions = []
+    candidates = []
+    step_stats = []
+    stop_reason = "iterations"
+    for i in range(iterations):
+        if max_secs is not None and time.perf_counter() - start >= max_secs:
+            stop_reason = "max_secs"
+            break
+        step_events = None
+        if on_event is not None:
+            # each call numbers its iterations from 0
+            step_events = lambda batch, i=i: on_event([dict(e, iteration=e["iteration"] + i) for e in batch])
+        step = compress(res["rewritten"] if res is not None else programs, 1, previous_abstractions=previous_abstractions + i, name_mapping=name_mapping, on_event=step_events, **kwargs).json
+        if "autotune" in step["args"]:
+            # tune once on the original corpus and stick with it, rather than recalibrating on every iteration
+            kwargs.update(autotune=False, threads=step["args"]["step"]["threads"], batch=step["args"]["step"]["batch"], dynamic_batch=step["args"]["step"]["dynamic_batch"])
+        if len(step["abstractions"]) == 0:
+            stop_reason = "no_compressive_abstraction"
+            if res is None:
+                res = step
+            break
+        original_cost = res["original_cost"] if res is not None else step["original_cost"]
+        abstraction = dict(step["abstractions"][0], cumulative_compression_ratio=original_cost / step["final_cost"])
+        previous_ratio = abstractions[-1]["cumulative_compression_ratio"] if abstractions else 1.
+        if min_utility is not None and abstraction["utility"] < min_utility:
+            stop_reason = "min_utility"
+        elif min_ratio_gain is not None and abstraction["cumulative_compression_ratio"] / previous_ratio - 1 < min_ratio_gain:
+            stop_reason = "min_ratio_gain"
+        if stop_reason != "iterations":
+            if res is None:
+                # nothing was kept, so this is just the original corpus
+                res = dict(step, rewritten=step["original"], final_cost=step["original_cost"])
+                if step.get("rewritten_dreamcoder") is not None:
+                    res["rewritten_dreamcoder"] = stitch_to_dreamcoder(step["original"], name_mapping)
+            break
+
+        abstractions.append(abstraction)
+        name_mapping.append((abstraction["name"], abstraction["dreamcoder"]))
+        candidates.extend(step.get("candidates", []))
+        step_stats.append(step["stats"])
+        if res is None:
+            res = step
+        else:
+            res = dict(step, original=res["original"], original_cost=res["original_cost"], args=res["args"])
+
+    if res is None:
+        # out of time before the first iteration, so just get the result of learning nothing
+        res = compress(programs, 0, previous_abstractions=previous_abstractions, name_mapping=name_mapping, **kwargs).json
+    res["abstractions"] = abstractions
+    res["num_abstractions"] = len(abstractions)
+    res["compression_ratio"] = res["original_cost"] / res["final_cost"]
+    res["args"] = dict(res["args"], iterations=iterations, previous_abstractions=previous_abstractions)
+    res["stop_reason"] = stop_reason
+    if "candidates" in res:
+        res["candidates"] = candidates
+    res["stats"] = merge_stats(step_stats) if step_stats else res["stats"]
+    res["stats"]["total_secs"] = time.perf_counter() - start
+    return CompressionResult(res)
+
+def merge_stats(step_stats: List[Dict[str,Any]]) -> Dict[str,Any]:
+    """
+    Combines the stats of several compress() calls into the stats of one call that did all of their work
+    """
+    stats: Dict[str,Any] = {}
+    for step in step_stats:
+        for k, v in step.items():
+            if k == "peak_rss_mb":
+                stats[k] = v if stats.get(k) is None else max(stats[k], v or 0)
+            elif k == "iterations":
+                stats.setdefault(k, []).extend(v)
+            elif isinstance(v, (int, float)):
+                stats[k] = stats.get(k, 0) + v
+    return stats
+
+OUTPUTS = ("abstractions", "rewritten", "original", "rewritten_dreamcoder", "uses", "intermediates")
+
+def drop_outputs(json_res: Dict[str,Any], outputs: Set[str]):
+    """
+    Removes the sections of an output json that aren't in ``outputs``, see compress()
+    """
+    for key in ("rewritten", "original", "rewritten_dreamcoder"):
+        if key not in outputs:
+            json_res.pop(key, None)
+    for a in json_res["abstractions"]:
+        if "uses" not in outputs:
+            a.pop("uses", None)
+        if "intermediates" not in outputs:
+            a.pop("rewritten", None)
+            a.pop("rewritten_dreamcoder", None)
+
+def select_outputs(res: CompressionResult, outputs: Union[Set[str],None]) -> CompressionResult:
+    """
+    The result with only the sections in ``outputs``, for the ways of running compress() that need the full output of the backend along the way
+    """
+    if outputs is None:
+        return res
+    drop_outputs(res.json, outputs)
+    return CompressionResult(res.json)
+
+# the kwargs that rewrite() accepts, which compress_sample() passes on when rewriting the full corpus
+REWRITE_KWARGS = ("cost_app", "cost_ivar", "cost_lam", "cost_prim_default", "cost_var", "panic_loud")
+
+def compress_sample(
+    programs: List[str],
+    iterations: int,
+    sample: Union[int,float],
+    sample_by: str,
+    sample_seed: int,
+    **kwargs
+    ) -> CompressionResult:
+    """
+    Runs compress(sample=...): searches for abstractions on a sample of the programs, then rewrites the full corpus with them
+    """
+    assert sample_by in ("task", "program"), f"sample_by must be \"task\" or \"program\", not {sample_by!r}"
+    tasks = kwargs.get("tasks")
+    indices = sample_indices(len(programs), sample, tasks if sample_by == "task" else None, sample_seed)
+    res = compress([programs[i] for i in indices], iterations, **sample_kwargs(indices, kwargs)).json
+
+    start = time.perf_counter()
+    rewritten = list(programs)
+    full_costs = None
+    # the backend's rewriter can't take an empty library
+    if len(res["abstractions"]) > 0:
+        rewrite_res = rewrite(programs, [Abstraction(a["name"], a["body"], a["arity"], a["tdfa_annotation"]) for a in res["abstractions"]],
+                              **{k: v for k, v in kwargs.items() if k in REWRITE_KWARGS})
+        rewritten = rewrite_res.rewritten
+        full_costs = (rewrite_res.json["original_cost"], rewrite_res.json["final_cost"])
+    return sample_result(res, programs, rewritten, dict(sample_by=sample_by, seed=sample_seed, num_programs=len(indices), rewrite_secs=time.perf_counter() - start),
+                         full_costs, **kwargs)
+
+def sample_kwargs(indices: List[int], kwargs: Dict[str,Any]) -> Dict[str,Any]:
+    """
+    The compress() kwargs for searching the programs at ``indices``, with their tasks and weights
+    """
+    kwargs = dict(kwargs)
+    if kwargs.get("tasks") is not None:
+        kwargs["tasks"] = [kwargs["tasks"][i] for i in indices]
+    if kwargs.get("weights") is not None:
+        kwargs["weights"] = [kwargs["weights"][i] for i in indices]
+    return kwargs
+
+def sample_result(res: Dict[str,Any], programs: List[str], rewritten: List[str], sample: Dict[str,Any], full_costs: Union[Tuple[float,float],None], **kwargs) -> CompressionResult:
+    """
+    Turns the output json of compress() on a sample into a result for the full corpus, given the full corpus ``rewritten`` with its abstractions.
+    ``full_costs`` are the original and final cost of the full corpus as reported by rewrite(), if it was called.
+    """
+    tasks = kwargs.get("tasks")
+    weights = kwargs.get("weights")
+    res["sample"] = dict(
+        sample,
+        original_cost=res["original_cost"],
+        final_cost=res["final_cost"],
+        compression_ratio=res["compression_ratio"],
+    )
+    res["original"] = programs
+    res["rewritten"] = rewritten
+    if full_costs is not None and tasks is None and weights is None and kwargs.get("cost_prim") is None:
+        res["original_cost"], res["final_cost"] = full_costs
+    else:
+        # rewrite() costs each program on its own with the default primitive costs, which only matches compress() without these
+        costs = cost_settings(res["args"]["step"])
+        res["original_cost"] = corpus_cost([parse(p) for p in programs], costs, tasks, weights)
+        res["final_cost"] = res["original_cost"] if full_costs is None else corpus_cost([parse(p) for p in rewritten], costs, tasks, weights)
+    res["compression_ratio"] = res["original_cost"] / res["final_cost"]
+    if res.get("rewritten_dreamcoder") is not None:
+        res["rewritten_dreamcoder"] = stitch_to_dreamcoder(rewritten, (kwargs.get("name_mapping") or []) + name_mapping_stitch(res))
+    return CompressionResult(res)
+
+# a run under max_memory_mb is stopped once it reaches this fraction of the cap, leaving room for memory allocated between checks
+MEMORY_CAP_MARGIN = 0.9
+# how often in seconds a run under max_memory_mb checks its memory
+MEMORY_CHECK_SECS = 0.01
+
+def compress_bounded(
+    programs: List[str],
+    iterations: int,
+    max_memory_mb: float,
+    sample: Union[int,float,None],
+    sample_by: str,
+    sample_seed: int,
+    **kwargs
+    ) -> CompressionResult:
+    """
+    Runs compress(max_memory_mb=...). The search runs in a child process that is stopped if it gets close to the cap, in which case it is
+    retried single-threaded on a sample of half as many programs (drawn as in compress(sample=...)), until it fits. If the search had to be
+    sampled, the full corpus is then rewritten in chunks of the sample's size in another child process, halving the chunks if they don't fit either.
+    """
+    assert kwargs.get("on_event") is None, "on_event can't be used with max_memory_mb, since the search runs in another process"
+    assert sample_by in ("task", "program"), f"sample_by must be \"task\" or \"program\", not {sample_by!r}"
+    limit_mb = max_memory_mb * MEMORY_CAP_MARGIN
+    stratify = kwargs.get("tasks") if sample_by == "task" else None
+    indices = list(range(len(programs))) if sample is None else sample_indices(len(programs), sample, stratify, sample_seed)
+    attempts = []
+    while True:
+        status, res, peak_mb = run_bounded(compress_json, ([programs[i] for i in indices], iterations, sample_kwargs(indices, kwargs)), limit_mb)
+        attempts.append(dict(phase="search", num_programs=len(indices), peak_mb=peak_mb, exceeded=status == "exceeded"))
+        if status == "ok":
+            break
+        if len(indices) <= 1:
+            raise MemoryError(f"compress() needs more than max_memory_mb={max_memory_mb} even on a single program")
+        indices = sample_indices(len(programs), len(indices) // 2, stratify, sample_seed)
+        # fewer threads means fewer partial results held in memory at once
+        kwargs = dict(kwargs, threads=1, batch=1, dynamic_batch=False, autotune=False)
+
+    if len(indices) < len(programs):
+        start = time.perf_counter()
+        rewritten = list(programs)
+        abstractions = [Abstraction(a["name"], a["body"], a["arity"], a["tdfa_annotation"]) for a in res["abstractions"]]
+        chunk_size = len(indices)
+        # the backend's rewriter can't take an empty library
+        full_costs = None
+        while len(abstractions) > 0:
+            status, rewrite_res, peak_mb = run_bounded(rewrite_in_chunks, (programs, abstractions, chunk_size, {k: v for k, v in kwargs.items() if k in REWRITE_KWARGS}), limit_mb)
+            attempts.append(dict(phase="rewrite", num_programs=chunk_size, peak_mb=peak_mb, exceeded=status == "exceeded"))
+            if status == "ok":
+                rewritten, full_costs = rewrite_res
+                break
+            if chunk_size <= 1:
+                raise MemoryError(f"rewrite() needs more than max_memory_mb={max_memory_mb} even on a single program")
+            chunk_size //= 2
+        res = sample_result(res, programs, rewritten, dict(sample_by=sample_by, seed=sample_seed, num_programs=len(indices), rewrite_secs=time.perf_counter() - start),
+                            full_costs, **kwargs).json
+
+    res["memory"] = dict(
+        max_memory_mb=max_memory_mb,
+        peak_mb=max(a["peak_mb"] for a in attempts),
+        limited=attempts[0]["exceeded"],
+        attempts=attempts,
+    )
     return CompressionResult(res)
+
+def compress_json(programs: List[str], iterations: int, kwargs: Dict[str,Any]) -> Dict[str,Any]:
+    return compress(programs, iterations, **kwargs).json
+
+def rewrite_in_chunks(programs: List[str], abstractions: List[Abstraction], chunk_size: int, kwargs: Dict[str,Any]) -> Tuple[List[str],Tuple[float,float]]:
+    """
+    Rewrites each chunk of ``chunk_size`` programs separately, which gives the same programs as rewriting them all at once with less memory.
+    Returns the rewritten programs along with their original and final cost, summed over the chunks.
+    """
+    rewritten = []
+    original_cost = final_cost = 0
+    for i in range(0, len(programs), chunk_size):
+        res = rewrite(programs[i:i+chunk_size], abstractions, **kwargs)
+        rewritten.extend(res.rewritten)
+        original_cost += res.json["original_cost"]
+        final_cost += res.json["final_cost"]
+    return rewritten, (original_cost, final_cost)
+
+def run_bounded(fn, args: Tuple, limit_mb: float) -> Tuple[str,Any,float]:
+    """
+    Calls ``fn(*args)`` in a child process that is stopped if its resident memory goes over ``limit_mb``. Returns ``("ok", result, peak_mb)``
+    or ``("exceeded", None, peak_mb)``, where ``peak_mb`` is the most memory the child was seen using, and re-raises any exception from ``fn``.
+
+    The child is a fresh Python interpreter rather than a fork, so its memory doesn't include whatever the caller has resident, and it's safe
+    to start from a process with other threads running (like a Session). ``fn``, ``args`` and the result are passed through pickle files.
+    """
+    with tempfile.TemporaryDirectory(prefix="stitch_core_bounded_") as tmp:
+        task_path = os.path.join(tmp, "task.pickle")
+        result_path = os.path.join(tmp, "result.pickle")
+        with open(task_path, "wb") as f:
+            pickle.dump((fn, args, limit_mb), f, protocol=pickle.HIGHEST_PROTOCOL)
+        # so that the child imports stitch_core (and anything fn needs) from the same place we did
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+        p = subprocess.run([sys.executable, "-c", "import stitch_core, sys; stitch_core.run_bounded_worker(*sys.argv[1:])", task_path, result_path], env=env)
+        if not os.path.exists(result_path):
+            raise StitchException(f"compression process exited unexpectedly with code {p.returncode}")
+        with open(result_path, "rb") as f:
+            status, val, peak_mb = pickle.load(f)
+    if status == "error":
+        raise val
+    return status, val, peak_mb
+
+def run_bounded_worker(task_path: str, result_path: str):
+    """
+    The entry point of the child process of run_bounded(), which writes ``(status, result, peak_mb)`` to ``result_path``
+    """
+    with open(task_path, "rb") as f:
+        fn, args, limit_mb = pickle.load(f)
+    peak_mb = current_rss_mb()
+    # only the first of the watchdog and the main thread to finish gets to write the result
+    done = threading.Lock()
+    def finish(record: Tuple[str,Any,float]):
+        done.acquire()
+        with open(result_path + ".tmp", "wb") as f:
+            pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(result_path + ".tmp", result_path)
+    def watchdog():
+        nonlocal peak_mb
+        while True:
+            rss = current_rss_mb()
+            peak_mb = max(peak_mb, rss)
+            if rss > limit_mb:
+                finish(("exceeded", None, peak_mb))
+                os._exit(1)
+            time.sleep(MEMORY_CHECK_SECS)
+    threading.Thread(target=watchdog, daemon=True).start()
+    try:
+        val = fn(*args)
+    except BaseException as e:
+        finish(("error", e, peak_mb))
+        return
+    finish(("ok", val, max(peak_mb, current_rss_mb())))
+
+def current_rss_mb() -> float:
+    """
+    Resident memory of the current process in megabytes, which is read from /proc on Linux and falls back to the peak elsewhere
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        return peak_rss_mb() or 0.
+
+def sample_indices(num_programs: int, sample: Union[int,float], tasks: Union[List[str],None], seed: int) -> List[int]:
+    """
+    The sorted indices of a random sample of programs, with ``sample`` either a number of programs or a fraction of them. If ``tasks``
+    are given the sample is stratified by task: each task keeps the sampled fraction of its programs, with the fractional part of a program
+    kept at random, so that the sample has the requested size on average.
+    """
+    fraction = sample if isinstance(sample, float) else sample / max(num_programs, 1)
+    assert fraction > 0, f"sample must be positive, not {sample}"
+    if fraction >= 1:
+        return list(range(num_programs))
+    rng = random.Random(seed)
+    if tasks is None:
+        return sorted(rng.sample(range(num_programs), max(1, round(fraction * num_programs))))
+
+    by_task: Dict[str,List[int]] = {}
+    for i, task in enumerate(tasks):
+        by_task.setdefault(task, []).append(i)
+    indices = []
+    for group in by_task.values():
+        expected = fraction * len(group)
+        k = int(expected) + (rng.random() < expected - int(expected))
+        indices.extend(rng.sample(group, k))
+    if len(indices) == 0:
+        indices.append(rng.randrange(num_programs))
+    return sorted(indices)
+
+# roughly how many corpus nodes of search work it takes for another thread to pay for its overhead
+AUTOTUNE_NODES_PER_THREAD = 10000
+# the number of programs that autotune="calibrate" times candidate settings on
+AUTOTUNE_SAMPLE_SIZE = 200
+
+def autotune_settings(
+    programs: List[str],
+    tasks: Union[List[str],None],
+    weights: Union[List[float],None],
+    max_arity: int,
+    calibrate: bool = False,
+    **kwargs
+    ) -> Dict[str,Any]:
+    """
+    Chooses ``threads``, ``batch`` and ``dynamic_batch`` for compress(autotune=True). Small corpora get one thread, since the search finishes
+    before more threads pay for their synchronization, and larger ones get a thread per ``AUTOTUNE_NODES_PER_THREAD`` nodes up to the number
+    of available cores. With several threads, a corpus whose largest programs are far bigger than its median program makes for worklist items of
+    very uneven cost, so it gets ``dynamic_batch``, while a more uniform corpus gets a fixed batch to cut contention on the shared worklist.
+
+    With ``calibrate=True`` these settings and a few alternatives are each timed on one iteration of compression over an evenly spaced
+    sample of ``AUTOTUNE_SAMPLE_SIZE`` programs, passing on the other ``kwargs``, and the fastest is chosen.
+
+    :return: the chosen ``threads``, ``batch`` and ``dynamic_batch`` along with the corpus statistics they were chosen from
+        (``num_programs``, ``total_nodes``, ``median_nodes``, ``max_nodes``), the number of available ``cores``,
+        and a ``calibration`` list of the settings that were timed and their ``secs``
+    :rtype: Dict[str,Any]
+    """
+    sizes = sorted(len(p.replace("(", " ").replace(")", " ").split()) for p in programs)
+    stats: Dict[str,Any] = dict(
+        num_programs=len(sizes),
+        total_nodes=sum(sizes),
+        median_nodes=sizes[len(sizes) // 2] if sizes else 0,
+        max_nodes=sizes[-1] if sizes else 0,
+        cores=available_cores(),
+    )
+
+    threads = max(1, min(stats["cores"], stats["total_nodes"] // AUTOTUNE_NODES_PER_THREAD))
+    if threads == 1:
+        settings = dict(threads=1, batch=1, dynamic_batch=False)
+    elif stats["max_nodes"] > 4 * stats["median_nodes"]:
+        settings = dict(threads=threads, batch=1, dynamic_batch=True)
+    else:
+        settings = dict(threads=threads, batch=4 if threads > 4 else 1, dynamic_batch=False)
+
+    calibration = []
+    if calibrate and stats["cores"] > 1:
+        step = max(1, len(programs) // AUTOTUNE_SAMPLE_SIZE)
+        sample = dict(
+            programs=programs[::step],
+            tasks=tasks[::step] if tasks is not None else None,
+            weights=weights[::step] if weights is not None else None,
+        )
+        kwargs = {k: v for k, v in kwargs.items() if k not in ("batch", "dynamic_batch", "silent")}
+        cores = stats["cores"]
+        candidates = [settings, dict(threads=1, batch=1, dynamic_batch=False), dict(threads=cores, batch=1, dynamic_batch=False), dict(threads=cores, batch=1, dynamic_batch=True), dict(threads=cores, batch=8, dynamic_batch=False)]
+        for candidate in candidates:
+            if any(candidate == timed["settings"] for timed in calibration):
+                continue
+            start = time.perf_counter()
+            compress(**sample, **kwargs, **candidate, iterations=1, max_arity=max_arity)
+            calibration.append(dict(settings=candidate, secs=time.perf_counter() - start))
+        settings = min(calibration, key=lambda timed: timed["secs"])["settings"]
+
+    return dict(settings, **stats, calibration=calibration)
+
+def available_cores() -> int:
+    """
+    The number of cores this process may run on, which can be fewer than os.cpu_count() under a scheduler or container
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError: # not available on macOS or Windows
+        return os.cpu_count() or 1
+
+class CompressJob:
+    """
+    One call to compress() to run with compress_many()
+
+    :param programs: the programs to compress
+    :type programs: List[str]
+    :param iterations: the number of iterations to run
+    :type iterations: int
+    :param \**kwargs: any other arguments to compress(), where ``threads`` is how many of the threads given to compress_many() this job uses at once
+    """
+    def __init__(self, programs: List[str], iterations: int, **kwargs):
+        self.programs = programs
+        self.iterations = iterations
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return f"CompressJob({len(self.programs)} programs, iterations={self.iterations})"
+
+def compress_many(
+    jobs: List[CompressJob],
+    threads: int = 1,
+    ) -> List[Union[CompressionResult,Exception]]:
+    """
+    Runs many independent compress() calls at once, sharing ``threads`` threads between them. Each job takes as many of the threads as
+    the ``threads`` it was created with (1 by default) for as long as it runs, and jobs are started largest corpus first so that a big
+    job doesn't end up running alone at the end. The Rust backend releases the GIL, so the jobs really do run in parallel.
+
+    Jobs that capture the backend's printouts (with ``return_candidates``, ``detailed_stats`` or ``on_event``) take turns with each
+    other, since only one capture of stdout can be active at a time.
+
+    :param jobs: the compress() calls to run
+    :type jobs: List[CompressJob]
+    :param threads: the total number of threads to use across all jobs
+    :type threads: int
+    :return: the result of each job in the same order as ``jobs``, or the exception it raised if it failed, without stopping the other jobs
+    :rtype: List[Union[CompressionResult,Exception]]
+    """
+    results: List[Any] = [None] * len(jobs)
+    free = threads
+    freed = threading.Condition()
+
+    def run(i: int):
+        nonlocal free
+        job = jobs[i]
+        need = max(1, min(job.kwargs.get("threads", 1), threads))
+        with freed:
+            freed.wait_for(lambda: free >= need)
+            free -= need
+        try:
+            results[i] = compress(job.programs, job.iterations, **dict(job.kwargs, threads=need))
+        except Exception as e:
+            results[i] = e
+        finally:
+            with freed:
+                free += need
+                freed.notify_all()
+
+    largest_first = sorted(range(len(jobs)), key=lambda i: -sum(len(p) for p in jobs[i].programs))
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(run, largest_first))
+    return results
+
+class Session:
+    """
+    A pool of worker threads that is created once and reused for many compress() and rewrite() calls, for workloads
+    with many small corpora where starting up threads for each call is a noticeable share of the time. Calls run one per worker
+    at a time, single-threaded unless given ``threads``, so the parallelism comes from running calls side by side.
+    The Rust backend releases the GIL, so they really do run in parallel.
+
+    Use it as a context manager, or call close() when done::
+
+        with Session(threads=8) as session:
+            futures = [session.submit_compress(programs, iterations=3) for programs in corpora]
+            results = [f.result() for f in futures]
+
+    :param threads: the number of worker threads, defaulting to the number of cores
+    :type threads: int
+    """
+    def __init__(self, threads: Union[int,None] = None):
+        self.size: int = threads or available_cores()
+        self.pool = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="stitch_session")
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.busy_secs = 0.
+        self.active = 0
+        self.calls = 0
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """Queues a call to ``fn(*args, **kwargs)`` on the pool, counted in utilization like the compress() and rewrite() calls, and returns a Future for its result"""
+        return self.pool.submit(self.run, fn, *args, **kwargs)
+
+    def submit_compress(self, programs: List[str], iterations: int, **kwargs) -> "Future[CompressionResult]":
+        """Queues a compress() call on the pool and returns a Future for its result"""
+        return self.submit(compress, programs, iterations, **kwargs)
+
+    def submit_rewrite(self, programs: List[str], abstractions: List[Abstraction], **kwargs) -> "Future[RewriteResult]":
+        """Queues a rewrite() call on the pool and returns a Future for its result"""
+        return self.submit(rewrite, programs, abstractions, **kwargs)
+
+    def compress(self, programs: List[str], iterations: int, **kwargs) -> CompressionResult:
+        """Runs compress() on the pool and waits for its result"""
+        return self.submit_compress(programs, iterations, **kwargs).result()
+
+    def rewrite(self, programs: List[str], abstractions: List[Abstraction], **kwargs) -> RewriteResult:
+        """Runs rewrite() on the pool and waits for its result"""
+        return self.submit_rewrite(programs, abstractions, **kwargs).result()
+
+    def run(self, fn, *args, **kwargs):
+        with self.lock:
+            self.active += 1
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.calls += 1
+                self.busy_secs += time.perf_counter() - start
+
+    @property
+    def utilization(self) -> Dict[str,Any]:
+        """
+        How busy the pool has been since it was created: the number of ``calls`` finished and ``active`` right now, the total ``busy_secs``
+        that workers spent in calls, the ``wall_secs`` since the pool was created, and ``utilization``, the fraction of the workers' time spent busy
+        """
+        with self.lock:
+            wall_secs = time.perf_counter() - self.started
+            return dict(size=self.size, calls=self.calls, active=self.active, busy_secs=self.busy_secs, wall_secs=wall_secs,
+                        utilization=self.busy_secs / (self.size * wall_secs) if wall_secs > 0 else 0.)
+
+    def close(self):
+        """Waits for any queued calls to finish and shuts down the workers"""
+        self.pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return f"Session(threads={self.size})"
+
+class RewritePool:
+    """
+    A pool of worker processes for rewriting many programs with one library, for jobs big enough to spread over every core. Each worker
+    is handed the library once when it starts (see rewrite_pool_init()), so only programs are sent with each task. Programs are sent in
+    chunks of ``chunk_size``, and imap() streams the results back in order while only reading a few chunks per worker ahead of them::
+
+        with RewritePool(res.abstractions, processes=8) as pool:
+            for rewritten in pool.imap(programs):
+                ...
+
+    :param library: the abstractions to rewrite with, or the path of a file to load them from with load_library() in each worker
+    :type library: Union[List[Abstraction],str,os.PathLike]
+    The workers are started with forkserver (or spawn where that isn't available) rather than forked, since forking a process that has other
+    threads running (like a Session's) can deadlock the child. Either way each worker re-imports the ``__main__`` module, so a script that makes
+    a RewritePool, or calls inline(), verify() or prune() with ``threads > 1``, has to guard its top-level code with ``if __name__ == "__main__":``.
+
+    :param processes: the number of worker processes, defaulting to the number of cores
+    :type processes: int
+    :param chunk_size: the number of programs to send to a worker at a time
+    :type chunk_size: int
+    :param \**kwargs: Additional arguments for rewrite(), like the costs.
+    """
+    def __init__(self, library: Union[List[Abstraction],str,os.PathLike], processes: Union[int,None] = None, chunk_size: int = 1000, **kwargs):
+        self.size: int = processes or available_cores()
+        self.chunk_size = chunk_size
+        self.pool = process_pool(self.size, initializer=rewrite_pool_init, initargs=(library, kwargs))
+
+    def imap_chunks(self, chunks: Iterable[List[str]]) -> Iterator[List[str]]:
+        """
+        Rewrites each chunk of programs on a worker, yielding the rewritten chunks in the same order. Only ``2 * processes``
+        chunks are read ahead of the one being yielded, so ``chunks`` can be a lazy iterator over a corpus that doesn't fit in memory.
+        """
+        pending = deque()
+        for chunk in chunks:
+            pending.append(self.pool.submit(rewrite_pool_chunk, chunk))
+            if len(pending) >= 2 * self.size:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def imap(self, programs: Iterable[str]) -> Iterator[str]:
+        """
+        Rewrites programs in chunks of ``chunk_size``, yielding each rewritten program in the same order as ``programs`` (see imap_chunks())
+        """
+        programs = iter(programs)
+        chunks = iter(lambda: list(islice(programs, self.chunk_size)), [])
+        for rewritten in self.imap_chunks(chunks):
+            yield from rewritten
+
+    def map(self, programs: Iterable[str]) -> List[str]:
+        """
+        Rewrites programs and returns them all at once, in the same order (see imap())
+        """
+        return list(self.imap(programs))
+
+    def close(self):
+        """Waits for any running chunks to finish and stops the workers"""
+        self.pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return f"RewritePool(processes={self.size})"
+
+# the library of the RewritePool that this process is a worker for, set once by rewrite_pool_init()
+REWRITE_POOL_LIBRARY: Tuple[List[Abstraction],Dict[str,Any]] = ([], {})
+
+def rewrite_pool_init(library: Union[List[Abstraction],str,os.PathLike], kwargs: Dict[str,Any]):
+    """
+    Runs once in each RewritePool worker as it starts, loading the library that all of its chunks are rewritten with
+    """
+    global REWRITE_POOL_LIBRARY
+    REWRITE_POOL_LIBRARY = (list(library) if isinstance(library, list) else load_library(library), kwargs)
+
+def rewrite_pool_chunk(programs: List[str]) -> List[str]:
+    """
+    The unit of work that a RewritePool hands out to each worker
+    """
+    abstractions, kwargs = REWRITE_POOL_LIBRARY
+    if len(abstractions) == 0:
+        return programs # the backend's rewriter can't take an empty library
+    return rewrite(programs, abstractions, outputs={"rewritten"}, **kwargs).rewritten
+
+class Timer:
+    """
+    Accumulates the time spent in each phase of a call into a ``stats`` dictionary, see CompressionResult.stats
+    """
+    def __init__(self):
+        self.start = self.last = time.perf_counter()
+        self.stats: Dict[str,Any] = {}
+
+    def lap(self, name: str):
+        """Records the time since the last lap under `name`"""
+        now = time.perf_counter()
+        self.stats[name] = now - self.last
+        self.last = now
+
+    def finish(self):
+        """Records the time since the last lap as post-processing, along with the total time and peak memory"""
+        self.lap("postprocess_secs")
+        self.stats["total_secs"] = self.last - self.start
+        self.stats["peak_rss_mb"] = peak_rss_mb()
+
+def peak_rss_mb() -> Union[float,None]:
+    """
+    Peak resident memory of the current process in megabytes, or None on platforms without the `resource` module (Windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    mem = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return mem / 1024 / 1024 if sys.platform == "darwin" else mem / 1024
+
+class CapturedOutput:
+    text: str = ""
+
+# redirecting a file descriptor affects the whole process, so only one capture can be active at a time. Calls that let the backend print
+# to stdout also hold this, so that their printouts can't end up in a capture
+capture_lock = threading.Lock()
+
+@contextmanager
+def capture_stdout(enabled: bool = True, on_line: Union[Callable[[str],None],None] = None, exclusive: bool = False):
+    """
+    Captures everything written to the stdout file descriptor while in the context, including printouts from the Rust
+    backend which bypass sys.stdout. The text is available on the yielded object's ``.text`` once the context exits.
+
+    If ``on_line`` is given, stdout is read through a pipe instead of a temporary file, and ``on_line`` is called on each
+    line from a background thread as soon as it is written.
+
+    The file descriptor is shared by the whole process, so anything else written to it in the meantime (from another thread or a C extension)
+    is captured too. To keep ordinary output working, ``sys.stdout`` is pointed at the original stdout for the duration when it was
+    writing to the file descriptor, so print() from any thread still shows up. Only one capture runs at a time, and with ``exclusive``
+    the context holds the same lock even when not capturing, for code that lets the backend print to stdout.
+    """
+    captured = CapturedOutput()
+    if not enabled:
+        with capture_lock if exclusive else nullcontext():
+            yield captured
+        return
+    with capture_lock:
+        if on_line is not None:
+            read_fd, write_fd = os.pipe()
+            lines = []
+            def reader():
+                with os.fdopen(read_fd, "rb") as f:
+                    for line in f:
+                        line = line.decode("utf-8", errors="replace")
+                        lines.append(line)
+                        on_line(line)
+            thread = threading.Thread(target=reader, daemon=True)
+            thread.start()
+            try:
+                with redirect_stdout_fd(write_fd):
+                    os.close(write_fd)
+                    yield captured
+            finally:
+                # restoring fd 1 closed the last write end of the pipe, so the reader sees EOF once it has drained everything
+                thread.join()
+                captured.text = "".join(lines)
+            return
+        with tempfile.TemporaryFile(mode="w+b") as tmp:
+            with redirect_stdout_fd(tmp.fileno()):
+                yield captured
+            tmp.seek(0)
+            captured.text = tmp.read().decode("utf-8", errors="replace")
+
+@contextmanager
+def redirect_stdout_fd(fd: int):
+    """
+    Points the stdout file descriptor at ``fd`` while in the context, and ``sys.stdout`` at the original stdout if it was writing to the file descriptor
+    """
+    saved_fd = os.dup(1)
+    original = sys.stdout
+    try:
+        swap = original.fileno() == 1
+    except (AttributeError, ValueError, OSError):
+        swap = False # eg in Jupyter, where sys.stdout doesn't write to the file descriptor anyways
+    if swap:
+        # on its own copy of the descriptor, so that a thread still holding it after the context is done writes to the right place
+        replacement = open(os.dup(saved_fd), "w", buffering=1, encoding=original.encoding, errors=original.errors)
+        sys.stdout = replacement
+    # anything already written through the original still goes to the original stdout
+    original.flush()
+    os.dup2(fd, 1)
+    try:
+        yield
+    finally:
+        os.dup2(saved_fd, 1)
+        if swap:
+            replacement.flush()
+            if sys.stdout is replacement: # unless something else replaced it in the meantime
+                sys.stdout = original
+        os.close(saved_fd)
+
+STEP_TIMING_RE = re.compile(r"^(TOTAL PREP|TOTAL SEARCH|post processing): (\d+)ms$")
+
+def parse_step_stats(text: str) -> Dict[str,Any]:
+    """
+    Parses the per-iteration timings and search counters out of the backend's step printouts, see CompressionResult.stats
+    """
+    iterations = []
+    for section in text.split("=======Iteration")[1:]:
+        iteration = {}
+        for line in section.splitlines():
+            match = STEP_TIMING_RE.match(line)
+            if match is not None:
+                key = {"TOTAL PREP": "prep_ms", "TOTAL SEARCH": "search_ms", "post processing": "postprocess_ms"}[match.group(1)]
+                iteration[key] = int(match.group(2))
+            elif line.startswith("Stats { ") and line.endswith(" }"):
+                for counter in line[len("Stats { "):-len(" }")].split(", "):
+                    name, val = counter.split(": ")
+                    iteration[name] = int(val)
+        iterations.append(iteration)
+    stats: Dict[str,Any] = dict(iterations=iterations)
+    match = re.search(r"^Time: (\d+)ms$", text, re.MULTILINE)
+    if match is not None:
+        stats["backend_ms"] = int(match.group(1))
+    return stats
+
+INVENTION_PATTERN = r"utility: (-?[\d.]+) \| final_cost: (-?[\d.]+) \| [\d.]+x \| uses: (\d+) \| body: \[(\S+) arity=(\d+): (.*)\]$"
+CANDIDATE_RE = re.compile(r"^(\d+): " + INVENTION_PATTERN)
+
+def parse_candidates(text: str) -> List[List[Dict[str,Any]]]:
+    """
+    Parses the ranked invention candidates out of the backend's step printouts, giving a list of candidates for each iteration
+    """
+    candidates = []
+    for section in text.split("=======Iteration")[1:]:
+        cost_before = None
+        iteration = []
+        for line in section.splitlines():
+            if line.startswith("Cost before: "):
+                cost_before = float(line[len("Cost before: "):])
+            match = CANDIDATE_RE.match(line)
+            if match is not None:
+                rank, utility, final_cost, num_uses, name, arity, body = match.groups()
+                iteration.append(dict(
+                    rank=int(rank),
+                    name=name,
+                    body=body,
+                    arity=int(arity),
+                    utility=json.loads(utility),
+                    final_cost=json.loads(final_cost),
+                    compression_ratio=cost_before / json.loads(final_cost),
+                    num_uses=int(num_uses),
+                ))
+        if len(iteration) > 0:
+            candidates.append(iteration)
+    return candidates
     
 
+# how often (in worklist steps) the backend prints its search counters when compress() is streaming events
+EVENT_STATS_EVERY = 1000
+# the least time between two calls to an on_event callback, other than at the end of an iteration
+EVENT_BATCH_SECS = 0.2
+
+ANSI_RE = re.compile(r"\x1b\[[0-9;]*m")
+NEW_BEST_RE = re.compile(r"^\[new best utility\] @ step=(\d+) util=(-?[\d.]+) trainratio=([\d.]+) for (.*): utility_upper_bound=.* usages=(\d+)$")
+CHOSEN_RE = re.compile(r"^Chose Invention \S+: " + INVENTION_PATTERN)
+
+class EventStream:
+    """
+    Turns the backend's step printouts into the progress events of compress(on_event=...) line by line,
+    handing them to the callback in batches (see :ref:`compress_events`). The callback runs on a dispatcher thread of its own
+    rather than the thread reading the backend's stdout, so a slow callback (or one that writes to stdout) never stops the pipe from draining.
+    """
+    def __init__(self, on_event: Callable[[List[Dict[str,Any]]],None]):
+        self.on_event = on_event
+        self.batch: List[Dict[str,Any]] = []
+        self.iteration = -1
+        self.cost_before = None
+        self.last_flush = time.perf_counter()
+        self.error: Union[BaseException,None] = None
+        self.batches = queue.Queue()
+        self.dispatcher = threading.Thread(target=self.dispatch, daemon=True, name="stitch_events")
+        self.dispatcher.start()
+
+    def line(self, line: str):
+        """Handles a line of backend output, which is called from the thread reading the backend's stdout so it must not raise"""
+        if self.error is not None:
+            return
+        try:
+            event = self.parse(ANSI_RE.sub("", line).strip())
+            if event is None:
+                return
+            self.batch.append(event)
+            if event["event"] == "iteration_end" or time.perf_counter() - self.last_flush >= EVENT_BATCH_SECS:
+                self.flush()
+        except BaseException as e:
+            self.error = e
+
+    def parse(self, line: str) -> Union[Dict[str,Any],None]:
+        if line.startswith("=======Iteration "):
+            self.iteration = int(line[len("=======Iteration "):].strip("="))
+            self.cost_before = None
+            return dict(event="iteration_start", iteration=self.iteration)
+        if line.startswith("Cost before: "):
+            self.cost_before = float(line[len("Cost before: "):])
+            return None
+        if line.startswith("Stats { ") and line.endswith(" }"):
+            event: Dict[str,Any] = dict(event="search_stats", iteration=self.iteration)
+            for counter in line[len("Stats { "):-len(" }")].split(", "):
+                name, val = counter.split(": ")
+                event[name] = int(val)
+            return event
+        match = NEW_BEST_RE.match(line)
+        if match is not None:
+            step, utility, train_ratio, body, num_uses = match.groups()
+            return dict(event="new_best", iteration=self.iteration, step=int(step), utility=json.loads(utility), compression_ratio=float(train_ratio), num_uses=int(num_uses), body=body)
+        match = CHOSEN_RE.match(line)
+        if match is not None:
+            utility, final_cost, num_uses, name, arity, body = match.groups()
+            abstraction = dict(
+                name=name,
+                body=body,
+                arity=int(arity),
+                utility=json.loads(utility),
+                final_cost=json.loads(final_cost),
+                compression_ratio=self.cost_before / json.loads(final_cost),
+                num_uses=int(num_uses),
+            )
+            return dict(event="iteration_end", iteration=self.iteration, abstraction=abstraction)
+        if line.startswith("No inventions found at iteration "):
+            return dict(event="iteration_end", iteration=self.iteration, abstraction=None)
+        return None
+
+    def flush(self):
+        batch, self.batch = self.batch, []
+        self.last_flush = time.perf_counter()
+        if len(batch) > 0:
+            self.batches.put(batch)
+
+    def dispatch(self):
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                return
+            if self.error is None:
+                try:
+                    self.on_event(batch)
+                except BaseException as e:
+                    self.error = e
+
+    def stop(self):
+        """Waits for the callback to get through the batches handed to it so far, then stops the dispatcher thread"""
+        self.batches.put(None)
+        self.dispatcher.join()
+
+    def finish(self):
+        """Delivers any events left over once the backend has returned, and re-raises an exception from the callback if there was one"""
+        self.flush()
+        self.stop()
+        if self.error is not None:
+            raise self.error
+
+def inline(
+    programs: List[str],
+    abstractions: List[Abstraction],
+    threads: int = 1,
+    ) -> List[str]:
+    """
+    Expands every use of the given abstractions in a list of programs, rewriting them back into the base DSL. This is
+    the inverse of rewrite(): each ``(fn_i a b)`` is replaced by the body of ``fn_i`` with ``a`` and ``b`` substituted
+    for ``#0`` and ``#1``, shifting the de Bruijn indices of the arguments as they are moved underneath any ``lam`` in the body.
+
+    Abstractions may call earlier abstractions in the list, and are expanded recursively. Any abstraction that
+    is not in ``abstractions`` is left untouched, so passing in a subset of a library only inlines that subset.
+    Partial applications are eta-expanded.
+
+    :param programs: A list of programs in stitch format, such as the ``.rewritten`` field of a CompressionResult.
+    :type programs: List[str]
+    :param abstractions: A list of Abstraction objects to inline, ordered so that abstractions come after any abstractions they call.
+    :type abstractions: List[Abstraction]
+    :param threads: The number of worker processes to use (no parallelism if set to 1). See RewritePool about using them from a script.
+    :type threads: int
+    :raises ParseError: If a program is malformed.
+    :return: The list of programs with all uses of the abstractions inlined.
+    :rtype: List[str]
+    """
+    return map_chunks(inline_chunk, [programs], inline_library(abstractions), threads)
+
+def verify(
+    original: List[str],
+    rewritten: List[str],
+    abstractions: List[Abstraction],
+    threads: int = 1,
+    ) -> VerifyResult:
+    """
+    Checks that rewritten programs are equivalent to the programs they were rewritten from, by inlining
+    the abstractions (see inline()) and comparing the result to the original up to alpha-equivalence. This
+    is the same round-trip check as ``rewrite_check=True`` but run after the fact, so it can be used to
+    validate the output of a compress() or rewrite() call without slowing down the search.
+
+    :param original: The programs before rewriting, such as ``res.json["original"]``.
+    :type original: List[str]
+    :param rewritten: The programs after rewriting, such as ``res.rewritten``.
+    :type rewritten: List[str]
+    :param abstractions: The abstractions that the programs were rewritten with.
+    :type abstractions: List[Abstraction]
+    :param threads: The number of worker processes to use (no parallelism if set to 1). See RewritePool about using them from a script.
+    :type threads: int
+    :raises ParseError: If a program is malformed.
+    :return: A VerifyResult listing the programs that did not round-trip.
+    :rtype: VerifyResult
+    """
+    assert len(original) == len(rewritten), f"got {len(original)} original programs but {len(rewritten)} rewritten programs"
+    mismatches = map_chunks(verify_chunk, [list(range(len(original))), original, rewritten], inline_library(abstractions), threads)
+    return VerifyResult(len(original), mismatches)
+
+def verify_chunk(indices: List[int], original: List[str], rewritten: List[str], library: Dict[str,Tuple[int,Any]]) -> List[Tuple[int,str,str]]:
+    """
+    The unit of work that verify() hands out to each worker, returns the mismatches in this chunk.
+    """
+    mismatches = []
+    for i, orig, rw in zip(indices, original, rewritten):
+        expanded = sexpr_inline(parse(rw), library)
+        # de Bruijn indices make alpha-equivalence structural equality, once both sides are normalized
+        if sexpr_normalize(expanded) != sexpr_normalize(parse(orig)):
+            mismatches.append((i, orig, show_sexpr(expanded)))
+    return mismatches
+
+def map_chunks(fn, columns: List[List[Any]], shared: Any, threads: int) -> List[Any]:
+    """
+    Calls `fn(*chunk_of_each_column, shared)` on chunks of the equal-length lists in `columns` and concatenates
+    the resulting lists, spreading the chunks over `threads` worker processes if `threads > 1`.
+    """
+    if threads <= 1 or len(columns[0]) < 2:
+        return fn(*columns, shared)
+
+    # a few chunks per worker so that uneven program sizes still balance out
+    chunksize = max(1, len(columns[0]) // (threads * 4))
+    chunks = [[column[i:i+chunksize] for column in columns] for i in range(0, len(columns[0]), chunksize)]
+    with process_pool(threads) as pool:
+        return [item for res in pool.map(fn, *zip(*chunks), repeat(shared)) for item in res]
+
+# how RewritePool and map_chunks() start their worker processes, see RewritePool
+POOL_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+def process_pool(processes: int, **kwargs) -> ProcessPoolExecutor:
+    """
+    A ProcessPoolExecutor with ``processes`` workers that are started with POOL_START_METHOD rather than the platform default (which is fork on Linux)
+    """
+    return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context(POOL_START_METHOD), **kwargs)
+
+def inline_library(abstractions: List[Abstraction]) -> Dict[str,Tuple[int,Any]]:
+    """
+    Parses the abstractions for inline() into a dictionary mapping each name to its arity and its body as an s-expression,
+    where the bodies have already had any earlier abstractions in the list inlined into them.
+    """
+    library = {}
+    for abstraction in abstractions:
+        library[abstraction.name] = (abstraction.arity, sexpr_inline(parse(abstraction.body), library))
+    return library
+
+def inline_chunk(programs: List[str], library: Dict[str,Tuple[int,Any]]) -> List[str]:
+    """
+    Inlines a library from inline_library() into a list of programs. This is the unit of work
+    that inline() hands out to each worker.
+    """
+    return [show_sexpr(sexpr_inline(parse(program), library)) for program in programs]
+
+def merge_libraries(
+    libraries: List[Union[List[Abstraction],CompressionResult]],
+    programs: Union[List[str],None] = None,
+    abstraction_prefix: str = "fn_",
+    **kwargs
+    ) -> MergeResult:
+    """
+    Merges the libraries learned by independent compress() runs into a single library without duplicates.
+
+    Two abstractions are duplicates if their bodies are the same once any abstractions they call have been
+    inlined and their ``#i`` arguments have been renumbered in order of first appearance, so neither the
+    argument order nor the names of nested abstractions matter. The first copy of each abstraction is kept,
+    and everything is renamed to ``fn_0``, ``fn_1``, etc. with calls to dropped duplicates redirected to the kept copy.
+
+    :param libraries: The libraries to merge, as lists of Abstraction objects or CompressionResults.
+    :type libraries: List[Union[List[Abstraction],CompressionResult]]
+    :param programs: If provided, the merged library is used to rewrite these programs to score each abstraction, see MergeResult.utilities.
+    :type programs: Union[List[str],None]
+    :param abstraction_prefix: The prefix used to name the abstractions in the merged library.
+    :type abstraction_prefix: str
+    :param \**kwargs: Additional arguments to pass to rewrite() when scoring the merged library on ``programs``.
+    :raises StitchException: If the Rust backend panics while rewriting ``programs``.
+    :return: A MergeResult containing the merged library and how each input abstraction was renamed.
+    :rtype: MergeResult
+    """
+    merged: List[Abstraction] = []
+    kept: Dict[str,Tuple[str,List[int]]] = {} # canonical body -> (merged name, order its #i first appear in)
+    redirects = []
+
+    for library in libraries:
+        if isinstance(library, CompressionResult):
+            library = library.abstractions
+        inlined = {} # bodies with this library's nested abstractions inlined, see inline_library()
+        redirect = {} # old name -> (merged name, arity, permutation of the arguments)
+        for abstraction in library:
+            body = sexpr_inline(parse(abstraction.body), inlined)
+            inlined[abstraction.name] = (abstraction.arity, body)
+            canonical, order = canonicalize_ivars(body, abstraction.arity)
+            if canonical not in kept:
+                name = abstraction_prefix + str(len(merged))
+                kept[canonical] = (name, order)
+                merged.append(Abstraction(name, show_sexpr(sexpr_redirect(parse(abstraction.body), redirect)), abstraction.arity, abstraction.tdfa_annotation))
+            name, kept_order = kept[canonical]
+            # argument j of the kept abstraction is argument permutation[j] of this one
+            permutation = [0] * abstraction.arity
+            for kept_ivar, ivar in zip(kept_order, order):
+                permutation[kept_ivar] = ivar
+            redirect[abstraction.name] = (name, abstraction.arity, permutation)
+        redirects.append(redirect)
+
+    num_duplicates = sum(len(redirect) for redirect in redirects) - len(merged)
+    rewrite_result = rewrite(programs, merged, **kwargs) if programs is not None else None
+    return MergeResult(merged, redirects, num_duplicates, rewrite_result)
+
+def canonicalize_ivars(body, arity: int) -> Tuple[str,List[int]]:
+    """
+    Renumbers the `#i` in an abstraction body in order of first appearance, returning the renumbered body as a string
+    (so it can be hashed) along with the list of the original `#i` in the order they first appear
+    """
+    order = []
+    def visit(sexpr):
+        if isinstance(sexpr, list):
+            for e in sexpr:
+                visit(e)
+        elif sexpr.startswith("#") and sexpr[1:].isdigit() and int(sexpr[1:]) not in order:
+            order.append(int(sexpr[1:]))
+    visit(body)
+    order += [i for i in range(arity) if i not in order] # unused arguments
+    mapping = {f"#{ivar}": f"#{i}" for (i, ivar) in enumerate(order)}
+    canonical = sexpr_replace(body, lambda x: isinstance(x, str) and x in mapping, lambda x: mapping[x])
+    return f"{arity}:{show_sexpr(canonical)}", order
+
+def prune(
+    result: CompressionResult,
+    min_uses: int = 1,
+    min_utility: float = 0,
+    tasks: Union[List[str],None] = None,
+    weights: Union[List[float],None] = None,
+    threads: int = 1,
+    ) -> CompressionResult:
+    """
+    Drops the abstractions of a compress() result that no longer pull their weight, such as abstractions that were
+    compressive when they were found but were later mostly subsumed by abstractions built on top of them.
+
+    For each abstraction, the number of uses and the marginal utility are recomputed against the final rewritten corpus.
+    The marginal utility is how much the corpus cost would go up if that abstraction alone were inlined (see inline()),
+    minus the structure penalty of its body, just like the ``utility`` that compress() reports when an abstraction is found.
+    Abstractions with fewer than ``min_uses`` uses or a marginal utility below ``min_utility`` are dropped, and only those
+    abstractions are inlined into the rewritten corpus and into the bodies of the abstractions that are kept, so no new
+    rewrite is needed.
+
+    The returned result keeps the names of the remaining abstractions, updates ``rewritten``, ``final_cost``,
+    ``compression_ratio``, ``num_abstractions`` and the ``body`` and ``num_uses`` of each abstraction, adds a ``marginal_utility``
+    to each abstraction, and lists the dropped abstractions under ``pruned``. Other fields still describe the original run.
+
+    :param result: The CompressionResult to prune.
+    :type result: CompressionResult
+    :param min_uses: Abstractions used fewer times than this in the rewritten corpus are dropped.
+    :type min_uses: int
+    :param min_utility: Abstractions with a marginal utility below this are dropped.
+    :type min_utility: float
+    :param tasks: The ``tasks`` that were passed to compress(), if any, so that the corpus cost matches the original run.
+    :type tasks: Union[List[str],None]
+    :param weights: The ``weights`` that were passed to compress(), if any, so that the corpus cost matches the original run.
+    :type weights: Union[List[float],None]
+    :param threads: The number of worker processes to use when inlining the dropped abstractions (no parallelism if set to 1). See RewritePool about using them from a script.
+    :type threads: int
+    :raises ValueError: If ``result`` has no ``rewritten`` programs (because compress() was called with ``outputs`` that leave them out), or if their cost
+        doesn't match its ``final_cost``, which means that ``tasks`` or ``weights`` differ from the original run.
+    :return: A new CompressionResult without the dropped abstractions.
+    :rtype: CompressionResult
+    """
+    if result.rewritten is None:
+        raise ValueError("prune() needs the rewritten programs, pass compress() outputs that include \"rewritten\"")
+    step_args = result.json["args"]["step"]
+    costs = cost_settings(step_args)
+    structure_penalty = 0 if step_args["no_other_util"] else step_args["structure_penalty"]
+    programs = [parse(p) for p in result.rewritten]
+    final_cost = corpus_cost(programs, costs, tasks, weights)
+    if not math.isclose(final_cost, result.json["final_cost"]):
+        # eg tasks or weights weren't passed in, so costs would come out per program while original_cost is per task
+        raise ValueError(f"the rewritten corpus costs {final_cost} but the result's final_cost is {result.json['final_cost']}, "
+                         "pass prune() the same tasks and weights that compress() was given")
+
+    uses = {a.name: 0 for a in result.abstractions}
+    count_symbols(programs, uses)
+
+    dropped = []
+    marginal_utilities = {}
+    for a in result.abstractions:
+        library = inline_library([a])
+        # inlining into the bodies of other abstractions changes their structure penalty too
+        body_growth = sum(body_cost(sexpr_inline(parse(other.body), library), costs) - body_cost(parse(other.body), costs) for other in result.abstractions)
+        corpus_growth = corpus_cost([sexpr_inline(p, library) for p in programs], costs, tasks, weights) - final_cost
+        marginal_utilities[a.name] = corpus_growth - structure_penalty * (body_cost(parse(a.body), costs) - body_growth)
+        if uses[a.name] < min_uses or marginal_utilities[a.name] < min_utility:
+            dropped.append(a)
+
+    library = inline_library(dropped)
+    rewritten = map_chunks(inline_chunk, [result.rewritten], library, threads)
+    json_res = dict(result.json)
+    json_res["rewritten"] = rewritten
+    json_res["final_cost"] = corpus_cost([parse(p) for p in rewritten], costs, tasks, weights)
+    json_res["compression_ratio"] = json_res["original_cost"] / json_res["final_cost"]
+    json_res["abstractions"] = [dict(a, body=show_sexpr(sexpr_inline(parse(a["body"]), library)), num_uses=uses[a["name"]], marginal_utility=marginal_utilities[a["name"]])
+                                for a in result.json["abstractions"] if a["name"] not in library]
+    json_res["num_abstractions"] = len(json_res["abstractions"])
+    json_res["pruned"] = [dict(name=a.name, body=a.body, num_uses=uses[a.name], marginal_utility=marginal_utilities[a.name]) for a in dropped]
+    if json_res.get("rewritten_dreamcoder") is not None:
+        json_res["rewritten_dreamcoder"] = stitch_to_dreamcoder(rewritten, name_mapping_stitch(json_res))
+    return CompressionResult(json_res)
+
+# the compact binary format of save_data(): a header, then the sections of BINARY_SECTIONS as little-endian arrays
+BINARY_MAGIC = b"STITCHB\x00"
+BINARY_VERSION = 1
+BINARY_SECTIONS = (("ops", "B"), ("ints", "q"), ("floats", "d"), ("strs", "I"), ("str_lens", "I"), ("text", "B"))
+BINARY_HEADER = struct.Struct(f"<8sII{2 * len(BINARY_SECTIONS)}Q")
+OP_NONE, OP_FALSE, OP_TRUE, OP_INT, OP_BIGINT, OP_FLOAT, OP_STR, OP_LIST, OP_DICT = range(9)
+
+def encode_binary(value: Any, compression_level: int = 6) -> bytes:
+    """
+    Encodes a json-like value (as from json.load()) in the compact binary format that save_data() writes. Each distinct string is
+    stored once, and every use of it (as a dict key or value) is an index into that table. The strings are concatenated into
+    a single zlib-compressed block of text, which shrinks the many similar programs in a result by more than an order of magnitude.
+    Numbers are stored as raw 64-bit ints and floats, and the structure as a flat array of one-byte opcodes. decode_binary() gives
+    back exactly the same value, except that tuples come back as lists.
+
+    :param value: A value made of dicts with string keys, lists, tuples, strings, ints, floats, bools and None.
+    :type value: Any
+    :param compression_level: The zlib compression level of the strings, from 1 (fastest) to 9 (smallest), or 0 to store them uncompressed.
+    :type compression_level: int
+    :return: The encoded value.
+    :rtype: bytes
+    """
+    ops = bytearray()
+    ints = array("q")
+    floats = array("d")
+    strs = array("I")
+    table: Dict[str,int] = {}
+
+    def add(v: Any):
+        if v is None:
+            ops.append(OP_NONE)
+        elif v is True or v is False:
+            ops.append(OP_TRUE if v else OP_FALSE)
+        elif isinstance(v, int):
+            if -2**63 <= v < 2**63:
+                ops.append(OP_INT)
+                ints.append(v)
+            else:
+                ops.append(OP_BIGINT)
+                strs.append(table.setdefault(str(v), len(table)))
+        elif isinstance(v, float):
+            ops.append(OP_FLOAT)
+            floats.append(v)
+        elif isinstance(v, str):
+            ops.append(OP_STR)
+            strs.append(table.setdefault(v, len(table)))
+        elif isinstance(v, (list, tuple)):
+            ops.append(OP_LIST)
+            ints.append(len(v))
+            for x in v:
+                add(x)
+        elif isinstance(v, dict):
+            ops.append(OP_DICT)
+            ints.append(len(v))
+            for k, x in v.items():
+                assert isinstance(k, str), f"only string keys can be encoded, not {k!r}"
+                strs.append(table.setdefault(k, len(table)))
+                add(x)
+        else:
+            raise TypeError(f"can't encode a {type(v).__name__} in the binary format")
+
+    add(value)
+    str_lens = array("I", [len(s) for s in table])
+    text = "".join(table).encode("utf-8")
+    if compression_level:
+        text = zlib.compress(text, compression_level)
+    sections = [ops, ints, floats, strs, str_lens, text]
+    if sys.byteorder == "big":
+        for section in sections[1:-1]:
+            section.byteswap()
+
+    header = []
+    body = bytearray()
+    offset = BINARY_HEADER.size
+    for section in sections:
+        data = bytes(section)
+        pad = -offset % 8 # keep each array aligned
+        body += b"\x00" * pad
+        offset += pad
+        header += [offset, len(data)]
+        body += data
+        offset += len(data)
+    return BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, compression_level > 0, *header) + bytes(body)
+
+def decode_binary(buffer: Union[bytes,memoryview,mmap.mmap]) -> Any:
+    """
+    Decodes a value encoded with encode_binary(). Only views of ``buffer`` are taken rather than copies of the whole thing, so
+    a memory-mapped file is decoded straight out of the page cache.
+
+    :param buffer: The encoded value.
+    :type buffer: Union[bytes,memoryview,mmap.mmap]
+    :raises ValueError: If ``buffer`` isn't in the binary format, or is from a newer version of it.
+    :return: The decoded value.
+    :rtype: Any
+    """
+    with memoryview(buffer) as view:
+        if len(view) < BINARY_HEADER.size or bytes(view[:len(BINARY_MAGIC)]) != BINARY_MAGIC:
+            raise ValueError("not in stitch's binary format")
+        magic, version, compressed, *header = BINARY_HEADER.unpack_from(view)
+        if version > BINARY_VERSION:
+            raise ValueError(f"binary format version {version} is newer than this version of stitch_core supports ({BINARY_VERSION})")
+
+        sections = []
+        for (name, typecode), offset, length in zip(BINARY_SECTIONS, header[0::2], header[1::2]):
+            with view[offset:offset + length] as section:
+                if typecode == "B":
+                    sections.append(bytes(section))
+                elif sys.byteorder == "big":
+                    sections.append(array(typecode, bytes(section)))
+                    sections[-1].byteswap()
+                else:
+                    with section.cast(typecode) as values:
+                        sections.append(values.tolist())
+    ops, ints, floats, strs, str_lens, text = sections
+
+    text = str(zlib.decompress(text) if compressed else text, "utf-8")
+    table = []
+    start = 0
+    for n in str_lens:
+        table.append(text[start:start + n])
+        start += n
+
+    next_op = iter(ops).__next__
+    next_int = iter(ints).__next__
+    next_float = iter(floats).__next__
+    next_str = map(table.__getitem__, strs).__next__
+
+    def read() -> Any:
+        op = next_op()
+        if op == OP_STR:
+            return next_str()
+        if op == OP_INT:
+            return next_int()
+        if op == OP_FLOAT:
+            return next_float()
+        if op == OP_DICT:
+            res = {}
+            for _ in range(next_int()):
+                k = next_str()
+                res[k] = read()
+            return res
+        if op == OP_LIST:
+            return [read() for _ in range(next_int())]
+        if op == OP_NONE:
+            return None
+        if op == OP_BIGINT:
+            return int(next_str())
+        return op == OP_TRUE
+
+    return read()
+
+# pickling trades a little size for speed, since results are usually sent between processes on the same machine
+PICKLE_COMPRESSION_LEVEL = 1
+
+def result_from_binary(cls: type, data: bytes) -> Union["CompressionResult","RewriteResult"]:
+    """
+    Rebuilds a pickled CompressionResult or RewriteResult from its ``.json`` encoded with encode_binary()
+    """
+    return cls(decode_binary(data))
+
+def save_data(value: Any, path: Union[str,os.PathLike], format: str = "binary", compression_level: int = 6):
+    """
+    Saves a json-like value, such as the ``.json`` of a CompressionResult, to a file. The "binary" format (see encode_binary()) is usually
+    dozens of times smaller than json. The "json" format writes indented json, like what's in ``data/expected_outputs``.
+
+    :param value: The value to save.
+    :type value: Any
+    :param path: The file to write.
+    :type path: Union[str,os.PathLike]
+    :param format: "binary" or "json".
+    :type format: str
+    :param compression_level: The ``compression_level`` of the binary format, see encode_binary().
+    :type compression_level: int
+    """
+    assert format in ("binary", "json"), f"format must be \"binary\" or \"json\", not {format!r}"
+    if format == "json":
+        with open(path, "w") as f:
+            json.dump(value, f, indent=4)
+    else:
+        with open(path, "wb") as f:
+            f.write(encode_binary(value, compression_level))
+
+def load_data(path: Union[str,os.PathLike], use_mmap: bool = False) -> Any:
+    """
+    Loads a value saved with save_data() in either format, telling them apart by the binary format's header.
+
+    :param path: The file to read.
+    :type path: Union[str,os.PathLike]
+    :param use_mmap: If True, memory-map a binary file instead of reading it in, so that its arrays are decoded straight from the page cache.
+    :type use_mmap: bool
+    :return: The loaded value.
+    :rtype: Any
+    """
+    with open(path, "rb") as f:
+        if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            f.seek(0)
+            return json.load(f)
+        if not use_mmap:
+            f.seek(0)
+            return decode_binary(f.read())
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return decode_binary(buf)
+
+def save_library(abstractions: List[Abstraction], path: Union[str,os.PathLike], format: str = "binary"):
+    """
+    Saves a list of abstractions (like ``res.abstractions``) to a file with save_data(), to be loaded with load_library().
+
+    :param abstractions: The abstractions to save.
+    :type abstractions: List[Abstraction]
+    :param path: The file to write.
+    :type path: Union[str,os.PathLike]
+    :param format: "binary" or "json".
+    :type format: str
+    """
+    save_data(dict(abstractions=[dict(name=a.name, body=a.body, arity=a.arity, tdfa_annotation=a.tdfa_annotation) for a in abstractions]), path, format)
+
+def load_library(path: Union[str,os.PathLike], use_mmap: bool = False) -> List[Abstraction]:
+    """
+    Loads the abstractions from a file written by save_library(), or from a saved CompressionResult in either format.
+
+    :param path: The file to read.
+    :type path: Union[str,os.PathLike]
+    :param use_mmap: See load_data().
+    :type use_mmap: bool
+    :return: The abstractions.
+    :rtype: List[Abstraction]
+    """
+    return [Abstraction(a["name"], a["body"], a["arity"], a.get("tdfa_annotation")) for a in load_data(path, use_mmap)["abstractions"]]
+
+def cost_settings(step_args: Dict[str,Any]) -> Dict[str,Any]:
+    """
+    Pulls the cost of each kind of node (see :ref:`cost_metrics`) out of the ``.json["args"]["step"]`` of a result
+    """
+    costs = dict(step_args["cost"])
+    costs["cost_prim"] = json.loads(costs["cost_prim"])
+    return costs
+
+def program_cost(sexpr, costs: Dict[str,Any]) -> float:
+    """
+    The cost of a program under the costs from cost_settings(), matching the cost that the Rust backend reports
+    """
+    if isinstance(sexpr, str):
+        if sexpr.startswith("$"):
+            return costs["cost_var"]
+        if sexpr.startswith("#"):
+            return costs["cost_ivar"]
+        return costs["cost_prim"].get(sexpr, costs["cost_prim_default"])
+    if is_lambda(sexpr):
+        return costs["cost_lam"] + program_cost(sexpr[1], costs)
+    # (f a b) is two applications
+    return costs["cost_app"] * (len(sexpr) - 1) + sum(program_cost(e, costs) for e in sexpr)
+
+def body_cost(sexpr, costs: Dict[str,Any]) -> float:
+    """
+    The size of an abstraction body used for its structure penalty, which doesn't charge for `#i`
+    """
+    return program_cost(sexpr, dict(costs, cost_ivar=0))
+
+def corpus_cost(programs: List[Any], costs: Dict[str,Any], tasks: Union[List[str],None] = None, weights: Union[List[float],None] = None) -> float:
+    """
+    The cost of a set of parsed programs, taking the cheapest program for each task (see :ref:`compression_objectives`)
+    """
+    if tasks is None:
+        tasks = list(range(len(programs)))
+    if weights is None:
+        weights = [1] * len(programs)
+    best = {}
+    for task, program, weight in zip(tasks, programs, weights):
+        cost = program_cost(program, costs) * weight
+        best[task] = min(best.get(task, cost), cost)
+    return sum(best.values())
+
 def build_arg(name: str, val) -> str:
     """
     Builds command line argument version of a Python argument, so for example:
@@ -391,11 +2395,134 @@ def dc_to_stitch_vars(sexpr, depth, num_args):
         else:
             return [dc_to_stitch_vars(e, depth, num_args) for e in sexpr]
 
+def is_lambda(sexpr) -> bool:
+    return isinstance(sexpr, list) and len(sexpr) > 0 and sexpr[0] in ("lambda", "lam")
+
+def sexpr_app(fn, args):
+    """
+    Applies `fn` to `args`, flattening into the existing application when `fn` is itself an application
+    since (f a b) is shorthand for ((f a) b)
+    """
+    if len(args) == 0:
+        return fn
+    if isinstance(fn, list) and not is_lambda(fn):
+        return fn + args
+    return [fn] + args
+
+def sexpr_normalize(sexpr):
+    """
+    Puts an s-expression in the form that stitch compares programs in, by flattening nested application heads
+    like ((f a) b) into (f a b) and writing every `lambda` as `lam`
+    """
+    if isinstance(sexpr, str) or len(sexpr) == 0:
+        return sexpr
+    if is_lambda(sexpr):
+        return ["lam", sexpr_normalize(sexpr[1])]
+    return sexpr_app(sexpr_normalize(sexpr[0]), [sexpr_normalize(e) for e in sexpr[1:]])
+
+def sexpr_shift(sexpr, amount, cutoff=0):
+    """
+    Shifts all de Bruijn indices `$i` that are free (ie point above `cutoff` lambdas) up by `amount`
+    """
+    if amount == 0:
+        return sexpr
+    if isinstance(sexpr, str):
+        if sexpr.startswith("$") and int(sexpr[1:]) >= cutoff:
+            return "$" + str(int(sexpr[1:]) + amount)
+        return sexpr
+    if is_lambda(sexpr):
+        return [sexpr[0], sexpr_shift(sexpr[1], amount, cutoff + 1)]
+    return [sexpr_shift(e, amount, cutoff) for e in sexpr]
+
+def sexpr_substitute(body, args, depth=0):
+    """
+    Substitutes `args[i]` for each `#i` in an abstraction body, shifting the free variables of
+    each argument by the number of lambdas (`depth`) that it ends up underneath
+    """
+    if isinstance(body, str):
+        if body.startswith("#") and body[1:].isdigit():
+            return sexpr_shift(args[int(body[1:])], depth)
+        return body
+    if is_lambda(body):
+        return [body[0], sexpr_substitute(body[1], args, depth + 1)]
+    return sexpr_app(sexpr_substitute(body[0], args, depth), [sexpr_substitute(e, args, depth) for e in body[1:]])
+
+def sexpr_apply_abstraction(arity, body, args):
+    """
+    Beta-reduces an abstraction applied to `args`. Any missing arguments are eta-expanded into
+    lambdas and any extra arguments are applied to the result.
+    """
+    missing = arity - len(args)
+    if missing > 0:
+        # the outermost new lambda binds the first missing argument
+        args = [sexpr_shift(arg, missing) for arg in args] + ["$" + str(missing - 1 - j) for j in range(missing)]
+    res = sexpr_substitute(body, args[:arity])
+    for _ in range(missing):
+        res = ["lam", res]
+    return sexpr_app(res, args[arity:])
+
+def sexpr_inline(sexpr, library):
+    """
+    Inlines all uses of the abstractions in `library` (see inline_library()) in an s-expression
+    """
+    if isinstance(sexpr, str):
+        if sexpr in library:
+            return sexpr_apply_abstraction(*library[sexpr], [])
+        return sexpr
+    if is_lambda(sexpr):
+        return [sexpr[0], sexpr_inline(sexpr[1], library)]
+    head = sexpr[0]
+    if isinstance(head, list) and not is_lambda(head):
+        # ((f a) b) is the same as (f a b)
+        return sexpr_inline(head + sexpr[1:], library)
+    if isinstance(head, str) and head in library:
+        # the arguments are substituted before they're inlined, so that an abstraction passed as an argument
+        # like `(fn_1 fn_0 x)` ends up applied by name and gets inlined as a whole rather than eta-expanded into a beta-redex
+        return sexpr_inline(sexpr_apply_abstraction(*library[head], sexpr[1:]), library)
+    return sexpr_app(sexpr_inline(head, library), [sexpr_inline(e, library) for e in sexpr[1:]])
+
+def sexpr_redirect(sexpr, redirect):
+    """
+    Renames the abstractions in an s-expression according to a `redirect` dictionary mapping each old name to its new name,
+    arity, and argument permutation (see merge_libraries()). Partial applications of an abstraction whose arguments get
+    reordered are eta-expanded first.
+    """
+    if isinstance(sexpr, str):
+        head, args = sexpr, []
+    elif is_lambda(sexpr):
+        return [sexpr[0], sexpr_redirect(sexpr[1], redirect)]
+    else:
+        head, args = sexpr[0], [sexpr_redirect(e, redirect) for e in sexpr[1:]]
+    if not (isinstance(head, str) and head in redirect):
+        return sexpr_app(sexpr_redirect(head, redirect), args) if isinstance(sexpr, list) else sexpr
+
+    name, arity, permutation = redirect[head]
+    if permutation == sorted(permutation):
+        return sexpr_app(name, args)
+    missing = max(0, arity - len(args))
+    if missing > 0:
+        args = [sexpr_shift(arg, missing) for arg in args] + ["$" + str(missing - 1 - j) for j in range(missing)]
+    res = sexpr_app(name, [args[permutation[j]] for j in range(arity)] + args[arity:])
+    for _ in range(missing):
+        res = ["lam", res]
+    return res
+
+def count_symbols(sexpr, counts: Dict[str,int]):
+    """
+    Increments `counts[symbol]` for each occurrence of a symbol in `sexpr` that is a key of `counts`
+    """
+    if isinstance(sexpr, str):
+        if sexpr in counts:
+            counts[sexpr] += 1
+    else:
+        for e in sexpr:
+            count_symbols(e, counts)
+
 def show_sexpr(sexpr):
     if isinstance(sexpr, str):
         return sexpr
     elif isinstance(sexpr, list):
-        if len(sexpr) != 0 and isinstance(sexpr[0], str) and sexpr[0].startswith("#"):
+        if len(sexpr) != 0 and sexpr[0] == "#":
             return "#(" + " ".join([show_sexpr(s) for s in sexpr[1:]]) + ")"
         return "(" + " ".join([show_sexpr(s) for s in sexpr]) + ")"
 
@@ -410,7 +2537,7 @@ def parse(original_s: str):
     for ease of identifying when a subexpression is a learned abstraction
     """
 
-    assert original_s.count('#(') == original_s.count('#'), "parser assumes all `#` symbols are followed by a `(` but this is not the case here"
+    assert original_s.count('#(') == len(re.findall(r'#(?!\d)', original_s)), "parser assumes all `#` symbols are followed by a `(` (or are `#i` abstraction variables) but this is not the case here"
 
     # add guaranteed parens around whole thing and guaranteed spacing around parens so they parse into their own items
     s = original_s.replace("#(","(# ").replace("(", " ( ").replace(")", " ) ")
@@ -419,13 +2546,14 @@ def parse(original_s: str):
     items = s.split()
     if len(items) == 0:
         raise ParseError("SExpr parse called on empty (or all whitespace) string")
-    if items[1] == ")":
-        raise ParseError("SExpr starts with a closeparen")
 
     # this is a single symbol like "foo" or "bar"
     if len(items) == 1:
         return items[0]
 
+    if items[1] == ")":
+        raise ParseError("SExpr starts with a closeparen")
+
     i=-1
     expr_stack = []
     # num_open_parens = Int[]
@@ -0,0 +1,214 @@
+"""
+Benchmarks compress() and rewrite() on the corpora bundled in the ``data/`` directory of the stitch_bindings repo.
+
+Each case comes from a file in ``data/expected_outputs`` named like ``house-a1-i1.json`` (corpus ``house``, ``max_arity=1``,
+``iterations=1``) and is run once per ``--threads`` setting, each time in a fresh process so that peak memory is
+measured per run. The utility and final cost of each learned abstraction are checked against the expected output
+(the bodies themselves are not compared, since abstractions with tied utilities can come out in either order).
+
+Typical usage, from a directory other than the root of the repo so that the installed stitch_core is benchmarked rather than the source
+tree's ``stitch_core/`` (which has no compiled backend)::
+
+    cd tests && python -m stitch_core.bench --data ../data --threads 1 4 --repeat 3 --out bench.json
+    cd tests && python -m stitch_core.bench --data ../data --threads 1 4 --baseline bench.json --threshold 0.2
+
+The process exits with a nonzero status if any case fails to run or its output doesn't match what is expected, or if its compress or
+rewrite time is slower than the same case in ``--baseline`` by more than ``--threshold``.
+"""
+from stitch_core import compress, rewrite, from_dreamcoder, peak_rss_mb
+from typing import Dict, List, Any, Union
+from multiprocessing import Process, Queue
+import argparse
+import glob
+import json
+import os
+import queue
+import re
+import sys
+import time
+
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+# the timings of each record that are checked against the baseline
+TIMINGS = ("compress_secs", "rewrite_secs")
+
+def find_cases(data_dir: str, filters: Union[List[str],None] = None) -> List[Dict[str,Any]]:
+    """
+    Lists the benchmark cases from the files in ``data/expected_outputs``, keeping only those whose name contains one of the ``filters``
+    """
+    cases = []
+    for path in sorted(glob.glob(os.path.join(data_dir, "expected_outputs", "*.json"))):
+        name = os.path.basename(path)[:-len(".json")]
+        match = re.fullmatch(r"(.*)-a(\d+)-i(\d+)", name)
+        if match is None:
+            continue
+        if filters and not any(f in name for f in filters):
+            continue
+        cases.append(dict(name=name, corpus=match.group(1), max_arity=int(match.group(2)), iterations=int(match.group(3)), expected=path))
+    return cases
+
+def load_corpus(corpus: str, data_dir: str) -> Dict[str,Any]:
+    """
+    Loads a bundled corpus as a dictionary of kwargs for compress(), translating from DreamCoder format where needed
+    """
+    for subdir in ("cogsci", "basic"):
+        path = os.path.join(data_dir, subdir, corpus + ".json")
+        if os.path.exists(path):
+            with open(path) as f:
+                return dict(programs=json.load(f))
+    if corpus.startswith("origami_"):
+        # origami_2 is the DreamCoder input from iteration 2
+        path, = glob.glob(os.path.join(data_dir, "dc", "origami", f"iteration_{corpus[len('origami_'):]}_*.json"))
+    else:
+        path = os.path.join(data_dir, "dc", corpus + ".json")
+    with open(path) as f:
+        return from_dreamcoder(json.load(f))
+
+def matches_expected(json_res: Dict[str,Any], expected: Dict[str,Any]) -> bool:
+    """
+    Checks the utility and final cost of each abstraction against an expected output (older outputs call the abstractions "invs")
+    """
+    expected_abstractions = expected["abstractions"] if "abstractions" in expected else expected["invs"]
+    return [(a["utility"], a["final_cost"]) for a in json_res["abstractions"]] == [(a["utility"], a["final_cost"]) for a in expected_abstractions]
+
+def run_case(case: Dict[str,Any], threads: int, data_dir: str) -> Dict[str,Any]:
+    """
+    Runs compress() on a case and then rewrite() on the same corpus with the learned abstractions, in the current process
+    """
+    kwargs = load_corpus(case["corpus"], data_dir)
+    with open(case["expected"]) as f:
+        expected = json.load(f)
+
+    start = time.perf_counter()
+    res = compress(**kwargs, iterations=case["iterations"], max_arity=case["max_arity"], threads=threads)
+    compress_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rewrite(kwargs["programs"], res.abstractions)
+    rewrite_secs = time.perf_counter() - start
+
+    return dict(
+        case=case["name"],
+        max_arity=case["max_arity"],
+        iterations=case["iterations"],
+        threads=threads,
+        compress_secs=compress_secs,
+        rewrite_secs=rewrite_secs,
+        peak_rss_mb=peak_rss_mb(),
+        num_abstractions=len(res.abstractions),
+        compression_ratio=res.json["compression_ratio"],
+        matches_expected=matches_expected(res.json, expected),
+    )
+
+def failed_record(case: Dict[str,Any], threads: int, error: str) -> Dict[str,Any]:
+    """
+    The record of a run that didn't finish, which counts as not matching the expected output
+    """
+    return dict(case=case["name"], max_arity=case["max_arity"], iterations=case["iterations"], threads=threads, error=error, matches_expected=False)
+
+def run_case_worker(case: Dict[str,Any], threads: int, data_dir: str, q: Queue):
+    try:
+        q.put(run_case(case, threads, data_dir))
+    except Exception as e:
+        q.put(failed_record(case, threads, f"{type(e).__name__}: {e}"))
+
+def run_isolated(case: Dict[str,Any], threads: int, data_dir: str) -> Dict[str,Any]:
+    """
+    Runs run_case() in a fresh process, so that its peak memory isn't inflated by earlier runs. If the case raises an exception
+    or the process dies, the case is recorded as failed (see failed_record()).
+    """
+    q = Queue()
+    p = Process(target=run_case_worker, args=(case, threads, data_dir, q))
+    p.start()
+    while True:
+        try:
+            record = q.get(timeout=0.1)
+            break
+        except queue.Empty:
+            if not p.is_alive() and q.empty():
+                record = failed_record(case, threads, f"benchmark process exited unexpectedly with code {p.exitcode}")
+                break
+    p.join()
+    return record
+
+def best_times(records: List[Dict[str,Any]]) -> Dict[str,float]:
+    """
+    The fastest compress and rewrite times of each case and thread count over all repeats, which are the least noisy numbers to compare
+    across runs, keyed like "house-a1-i1@1 compress_secs"
+    """
+    best = {}
+    for r in records:
+        if "error" in r:
+            continue
+        for timing in TIMINGS:
+            key = f"{r['case']}@{r['threads']} {timing}"
+            best[key] = min(best.get(key, r[timing]), r[timing])
+    return best
+
+def find_regressions(records: List[Dict[str,Any]], baseline: List[Dict[str,Any]], threshold: float, min_secs: float) -> List[str]:
+    """
+    Describes each case whose compress or rewrite time got slower than the baseline by more than ``threshold`` (a fraction, so 0.2 is 20% slower).
+    Times that were less than ``min_secs`` in the baseline are skipped since they are too short to measure reliably.
+    """
+    regressions = []
+    current = best_times(records)
+    for key, old in best_times(baseline).items():
+        if key in current and old >= min_secs and current[key] > old * (1 + threshold):
+            regressions.append(f"{key}: {current[key]:.3f}s vs {old:.3f}s in baseline ({current[key] / old - 1:+.0%})")
+    return regressions
+
+def main(argv: Union[List[str],None] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m stitch_core.bench", description="Benchmark compress() and rewrite() on the bundled corpora")
+    parser.add_argument("cases", nargs="*", help="only run cases whose name contains one of these, like `house` or `a3-i10`")
+    parser.add_argument("--data", default=DEFAULT_DATA_DIR, help="the repo's data/ directory")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1], help="thread counts to run each case with")
+    parser.add_argument("--repeat", type=int, default=1, help="number of times to run each case and thread count")
+    parser.add_argument("--out", help="write the results to this json file")
+    parser.add_argument("--baseline", help="json file from an earlier --out to check for slowdowns against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="fail if a case is this much slower than the baseline, as a fraction")
+    parser.add_argument("--min-secs", type=float, default=0.05, help="don't check cases that took less than this long in the baseline")
+    args = parser.parse_args(argv)
+
+    cases = find_cases(args.data, args.cases)
+    if len(cases) == 0:
+        print(f"no benchmark cases found in {args.data}", file=sys.stderr)
+        return 1
+
+    records = []
+    print(f"{'case':<28}{'threads':>8}{'compress':>11}{'rewrite':>10}{'rss (MB)':>10}{'ratio':>8}  ok")
+    for case in cases:
+        for threads in args.threads:
+            for _ in range(args.repeat):
+                r = run_isolated(case, threads, args.data)
+                records.append(r)
+                if "error" in r:
+                    print(f"{r['case']:<28}{threads:>8}  failed: {r['error']}", flush=True)
+                    continue
+                print(f"{r['case']:<28}{threads:>8}{r['compress_secs']:>10.3f}s{r['rewrite_secs']:>9.3f}s{r['peak_rss_mb'] or 0:>10.1f}{r['compression_ratio']:>8.2f}  {'yes' if r['matches_expected'] else 'NO'}", flush=True)
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(dict(records=records), f, indent=4)
+        print(f"wrote {args.out}")
+
+    failed = False
+    errored = sorted(set(r["case"] for r in records if "error" in r))
+    if errored:
+        print(f"failed to run: {', '.join(errored)}")
+        failed = True
+    mismatched = sorted(set(r["case"] for r in records if not r["matches_expected"] and "error" not in r))
+    if mismatched:
+        print(f"outputs don't match data/expected_outputs for: {', '.join(mismatched)}")
+        failed = True
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["records"]
+        regressions = find_regressions(records, baseline, args.threshold, args.min_secs)
+        for regression in regressions:
+            print(f"slower than baseline: {regression}")
+        failed = failed or len(regressions) > 0
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
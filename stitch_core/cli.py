@@ -0,0 +1,168 @@
+"""
+The ``python -m stitch_core`` command line, for running stitch from batch jobs without a Python driver script.
+
+``rewrite`` rewrites a JSON Lines file of programs (one JSON string per line) with a library, streaming it through in chunks so that
+memory stays flat no matter how big the file is. Chunks are rewritten in parallel on a Session and written out in their original order,
+with at most two chunks per thread read ahead of the writer::
+
+    python -m stitch_core rewrite --library lib.json --in programs.jsonl --out rewritten.jsonl --threads 8
+
+``compress`` learns a library from a file of programs and saves the result json (the same as ``CompressionResult.json``, as compact json or in the binary
+format of save_data()), printing the abstractions, the timing and memory stats, and with ``--verbose`` the backend's progress to stderr::
+
+    python -m stitch_core compress data/cogsci/house.json --iterations 10 --max-arity 3 --threads 8 --out result.json
+
+The programs are read from a ``.json`` file holding either a list of programs or DreamCoder-format frontiers (see from_dreamcoder()),
+from a ``.jsonl`` file with one JSON string per line, or from any other file as plain text with one program per line (see bulk_list()).
+
+For ``rewrite``, the library is either the saved output of a compress() call (whose cost settings are also used for rewriting), a file from
+save_library(), or a json list of abstractions with a ``name``, ``body`` and ``arity`` each. ``-`` reads from stdin or writes to stdout, and a summary of the run goes to stderr.
+"""
+from stitch_core import compress, from_dreamcoder, bulk_list, load_data, encode_binary, redirect_stdout_fd, Abstraction, Session, OUTPUTS, REWRITE_KWARGS, peak_rss_mb
+from collections import deque
+from contextlib import nullcontext, redirect_stdout
+from itertools import islice
+from typing import ContextManager, Dict, Iterable, Iterator, List, Any, IO, Tuple, Union
+import argparse
+import json
+import pathlib
+import sys
+import time
+
+def load_rewrite_library(path: str) -> Tuple[List[Abstraction],Dict[str,Any]]:
+    """
+    Loads the abstractions to rewrite with from a json or binary file (see load_data()), along with the rewrite() kwargs for the cost settings they were learned with, if known
+    """
+    data = load_data(path)
+    abstractions = data["abstractions"] if isinstance(data, dict) else data
+    abstractions = [Abstraction(a["name"], a["body"], a["arity"], a.get("tdfa_annotation")) for a in abstractions]
+    kwargs = {}
+    if isinstance(data, dict) and "args" in data:
+        kwargs = {k: v for k, v in data["args"]["step"]["cost"].items() if k in REWRITE_KWARGS}
+    return abstractions, kwargs
+
+def read_chunks(f: IO[str], chunk_size: int) -> Iterator[List[str]]:
+    """
+    Reads a JSON Lines file of programs lazily, ``chunk_size`` programs at a time, skipping blank lines
+    """
+    lines = (line for line in f if line.strip())
+    while True:
+        chunk = [json.loads(line) for line in islice(lines, chunk_size)]
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+def rewrite_chunks(chunks: Iterable[List[str]], abstractions: List[Abstraction], threads: int, **kwargs) -> Iterator[List[str]]:
+    """
+    Rewrites each chunk of programs with rewrite(), running up to ``threads`` chunks at once and yielding the results in the order of ``chunks``.
+    Only ``2 * threads`` chunks are read ahead, so memory doesn't grow with the number of chunks.
+    """
+    if len(abstractions) == 0:
+        # the backend's rewriter can't take an empty library, and there's nothing to rewrite with anyways
+        yield from chunks
+        return
+    with Session(threads) as session:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(session.submit_rewrite(chunk, abstractions, outputs={"rewritten"}, **kwargs))
+            if len(pending) >= 2 * threads:
+                yield pending.popleft().result().rewritten
+        while pending:
+            yield pending.popleft().result().rewritten
+
+def open_stream(path: str, mode: str) -> ContextManager[IO[str]]:
+    """
+    Opens a file, or stdin or stdout for ``-`` (which are left open afterwards)
+    """
+    if path == "-":
+        return nullcontext(sys.stdin if "r" in mode else sys.stdout)
+    return open(path, mode)
+
+def rewrite_command(args: argparse.Namespace) -> int:
+    abstractions, kwargs = load_rewrite_library(args.library)
+    start = time.perf_counter()
+    num_programs = 0
+    with open_stream(args.input, "r") as fin, open_stream(args.out, "w") as fout:
+        for rewritten in rewrite_chunks(read_chunks(fin, args.chunk_size), abstractions, args.threads, **kwargs):
+            fout.write("".join(json.dumps(program) + "\n" for program in rewritten))
+            num_programs += len(rewritten)
+    secs = time.perf_counter() - start
+    print(f"rewrote {num_programs} programs with {len(abstractions)} abstractions in {secs:.3f}s (peak rss {peak_rss_mb() or 0:.1f}MB)", file=sys.stderr)
+    return 0
+
+def load_programs(path: str) -> Dict[str,Any]:
+    """
+    Loads a file of programs as a dictionary of kwargs for compress(), based on its extension (see above)
+    """
+    if path.endswith(".json"):
+        with open(path) as f:
+            data = json.load(f)
+        return from_dreamcoder(data) if isinstance(data, dict) else dict(programs=data)
+    if path.endswith(".jsonl"):
+        with open(path) as f:
+            return dict(programs=[json.loads(line) for line in f if line.strip()])
+    return dict(programs=bulk_list(pathlib.Path(path)))
+
+def save_result(json_res: Dict[str,Any], path: str, format: str):
+    """
+    Writes a result json to a file or stdout (for ``-``), as compact json or in the binary format of save_data()
+    """
+    if format == "binary":
+        data = encode_binary(json_res)
+    else:
+        data = json.dumps(json_res, separators=(",", ":")).encode()
+    if path == "-":
+        sys.stdout.flush()
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+    else:
+        with open(path, "wb") as f:
+            f.write(data)
+
+def compress_command(args: argparse.Namespace) -> int:
+    start = time.perf_counter()
+    kwargs = load_programs(args.input)
+    load_secs = time.perf_counter() - start
+    # the backend's progress goes to stderr along with everything else we print, so that stdout only ever has the result
+    with redirect_stdout_fd(sys.stderr.fileno()), redirect_stdout(sys.stderr):
+        res = compress(**kwargs, iterations=args.iterations, max_arity=args.max_arity, threads=args.threads, silent=not args.verbose,
+                       autotune=args.autotune, max_memory_mb=args.max_memory_mb, max_secs=args.max_secs, outputs=args.outputs)
+    res.json["stats"]["load_secs"] = load_secs
+    if args.out is not None:
+        save_result(res.json, args.out, args.format)
+
+    for a in res.json["abstractions"]:
+        print(f"{a['name']} (utility {a['utility']}, arity {a['arity']}): {a['body']}", file=sys.stderr)
+    stats = res.stats
+    print(f"learned {len(res.abstractions)} abstractions from {len(kwargs['programs'])} programs ({res.json['stop_reason']}), compression ratio {res.json['compression_ratio']:.2f}", file=sys.stderr)
+    print(f"loaded in {load_secs:.3f}s, compressed in {stats['total_secs']:.3f}s (backend {stats['backend_secs']:.3f}s), peak rss {peak_rss_mb() or 0:.1f}MB", file=sys.stderr)
+    return 0
+
+def main(argv: Union[List[str],None] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m stitch_core", description="Run stitch from the command line")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    compress_parser = subparsers.add_parser("compress", help="learn abstractions from a file of programs")
+    compress_parser.add_argument("input", help="a .json list of programs or DreamCoder frontiers, a .jsonl file, or a text file with one program per line")
+    compress_parser.add_argument("--iterations", type=int, required=True)
+    compress_parser.add_argument("--max-arity", type=int, default=2)
+    compress_parser.add_argument("--threads", type=int, default=1)
+    compress_parser.add_argument("--autotune", action="store_true", help="choose threads and batching from the corpus, see autotune_settings()")
+    compress_parser.add_argument("--max-memory-mb", type=float, help="keep the search and rewriting under this much memory")
+    compress_parser.add_argument("--max-secs", type=float, help="don't start another iteration after this many seconds")
+    compress_parser.add_argument("--outputs", nargs="+", choices=OUTPUTS, help="only save these sections of the result json")
+    compress_parser.add_argument("--out", help="write the result json here, or - for stdout")
+    compress_parser.add_argument("--format", choices=["json", "binary"], default="json", help="save the result as compact json or in the binary format, see save_data()")
+    compress_parser.add_argument("--verbose", action="store_true", help="print the backend's progress to stderr")
+    compress_parser.set_defaults(run=compress_command)
+
+    rewrite_parser = subparsers.add_parser("rewrite", help="rewrite a JSON Lines file of programs with a library")
+    rewrite_parser.add_argument("--library", required=True, help="a compress() output json, or a json list of abstractions")
+    rewrite_parser.add_argument("--in", dest="input", required=True, help="a JSON Lines file with one program per line, or - for stdin")
+    rewrite_parser.add_argument("--out", required=True, help="where to write the rewritten programs as JSON Lines, or - for stdout")
+    rewrite_parser.add_argument("--threads", type=int, default=1, help="number of chunks to rewrite at once")
+    rewrite_parser.add_argument("--chunk-size", type=int, default=1000, help="number of programs to rewrite per call")
+    rewrite_parser.set_defaults(run=rewrite_command)
+
+    args = parser.parse_args(argv)
+    return args.run(args)
@@ -0,0 +1,99 @@
+"""
+Benchmarks a running stitch_core.serve server by sending it rewrite requests from many connections at once.
+
+Each of ``--concurrency`` client threads keeps one connection open and sends its share of ``--requests`` requests back to back, each
+with ``--per-request`` programs taken in turn from a JSON Lines file (one JSON string per line). The throughput and the client-side
+latency percentiles are printed, along with the server's own /stats::
+
+    python -m stitch_core.serve --library logo=lib.json --threads 4 &
+    python -m stitch_core.loadgen programs.jsonl --address 127.0.0.1:8765 --concurrency 16 --requests 2000
+
+The address is ``host:port`` or ``unix:/path/to.sock``. The process exits with a nonzero status if any request failed.
+"""
+from stitch_core.serve import connect, call, percentiles
+from typing import Dict, List, Any, Union
+import argparse
+import json
+import sys
+import threading
+import time
+
+def run_load(address: str, programs: List[str], num_requests: int, concurrency: int, per_request: int = 1, library: Union[str,None] = None) -> Dict[str,Any]:
+    """
+    Sends ``num_requests`` rewrite requests split over ``concurrency`` connections, returning the throughput, latency percentiles in
+    milliseconds, the number of failed requests, and the server's /stats afterwards
+    """
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+
+    def client(index: int):
+        conn = connect(address)
+        mine = []
+        failed = 0
+        for i in range(index, num_requests, concurrency):
+            body = dict(programs=[programs[(i * per_request + j) % len(programs)] for j in range(per_request)])
+            if library is not None:
+                body["library"] = library
+            start = time.perf_counter()
+            try:
+                status, _ = call(conn, "POST", "/rewrite", body)
+            except OSError:
+                status = None
+                conn.close() # reconnects on the next request
+            mine.append(time.perf_counter() - start)
+            failed += status != 200
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+            failures.append(failed)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    secs = time.perf_counter() - start
+
+    conn = connect(address)
+    _, server_stats = call(conn, "GET", "/stats")
+    conn.close()
+    return dict(
+        requests=len(latencies),
+        failed=sum(failures),
+        secs=secs,
+        requests_per_sec=len(latencies) / secs,
+        programs_per_sec=len(latencies) * per_request / secs,
+        latency_ms={k: v * 1000 for k, v in percentiles(latencies).items()},
+        server=server_stats,
+    )
+
+def main(argv: Union[List[str],None] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m stitch_core.loadgen", description="Benchmark a running stitch_core.serve server")
+    parser.add_argument("programs", help="a JSON Lines file of programs to send")
+    parser.add_argument("--address", default="127.0.0.1:8765", help="host:port or unix:/path/to.sock of the server")
+    parser.add_argument("--library", help="the library to rewrite with, if the server has more than one")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8, help="number of connections sending requests at once")
+    parser.add_argument("--per-request", type=int, default=1, help="number of programs in each request")
+    parser.add_argument("--out", help="write the results to this json file")
+    args = parser.parse_args(argv)
+
+    with open(args.programs) as f:
+        programs = [json.loads(line) for line in f if line.strip()]
+    res = run_load(args.address, programs, args.requests, args.concurrency, args.per_request, args.library)
+
+    lat = res["latency_ms"]
+    print(f"{res['requests']} requests ({res['failed']} failed) in {res['secs']:.3f}s: {res['requests_per_sec']:.1f} requests/s, {res['programs_per_sec']:.1f} programs/s")
+    print(f"client latency: p50 {lat['p50']:.2f}ms  p90 {lat['p90']:.2f}ms  p99 {lat['p99']:.2f}ms  max {lat['max']:.2f}ms")
+    server = res["server"]
+    print(f"server: {server['batches']} batches of {server['mean_batch_programs']:.1f} programs on average, latency p50 {server['latency_ms']['p50']:.2f}ms  p99 {server['latency_ms']['p99']:.2f}ms")
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(res, f, indent=4)
+        print(f"wrote {args.out}")
+    return 1 if res["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
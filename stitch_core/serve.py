@@ -0,0 +1,370 @@
+"""
+A long-lived local server that rewrites programs with libraries that are loaded once at startup, for services that would otherwise
+call rewrite() on every program that comes in. It listens on localhost over HTTP, or on a Unix socket::
+
+    python -m stitch_core.serve --library logo=lib.json --port 8765 --threads 4
+    python -m stitch_core.serve --library logo=lib.json --library origami=result.bin --unix /tmp/stitch.sock
+
+Each ``--library`` is ``name=path``, where the file is anything ``python -m stitch_core rewrite --library`` takes. The endpoints take and give json:
+
+ - ``POST /rewrite`` with ``{"library": "logo", "programs": [...]}`` returns ``{"rewritten": [...]}``. The ``library`` can be left out if only one is loaded.
+ - ``GET /stats`` returns the number of requests, programs and batches so far, the mean batch size, and percentiles of the time from
+   a request arriving to its response being ready (``latency_ms``, over the most recent requests).
+ - ``GET /libraries`` returns the name and number of abstractions of each library.
+
+Concurrent requests for the same library are combined into micro-batches: the first request of a batch waits up to ``--batch-ms`` for
+others to join it (or until the batch has ``--batch-size`` programs), and the whole batch goes to the backend in one rewrite() call on a
+Session with ``--threads`` workers, so the per-call overhead is paid once per batch rather than once per request. If a batch fails (say
+because one request had an unparseable program), its requests are retried one at a time so that only the bad one gets the error.
+
+See stitch_core.loadgen for a load generator to benchmark a running server with.
+"""
+from stitch_core import Session, peak_rss_mb, rewrite
+from stitch_core.cli import load_rewrite_library
+from concurrent.futures import Future
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from collections import deque
+from typing import Dict, List, Any, Tuple, Union
+import argparse
+import json
+import os
+import queue
+import socket
+import stat
+import sys
+import threading
+import time
+
+# the number of most recent requests that latency percentiles are taken over
+LATENCY_WINDOW = 10000
+
+def percentiles(values: List[float], ps: Tuple[int,...] = (50, 90, 99)) -> Dict[str,float]:
+    """
+    The ``ps`` percentiles of some values (nearest-rank), along with their mean and max, keyed like "p50", "mean" and "max"
+    """
+    if len(values) == 0:
+        return {}
+    values = sorted(values)
+    res = {f"p{p}": values[min(len(values) - 1, len(values) * p // 100)] for p in ps}
+    res.update(mean=sum(values) / len(values), max=values[-1])
+    return res
+
+class ServerStats:
+    """
+    Thread-safe counters and a window of recent latencies for the /stats endpoint
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.programs = 0
+        self.batches = 0
+        self.batched_programs = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def request(self, num_programs: int, secs: float, ok: bool):
+        with self.lock:
+            self.requests += 1
+            self.programs += num_programs
+            self.errors += not ok
+            self.latencies.append(secs)
+
+    def batch(self, num_programs: int):
+        with self.lock:
+            self.batches += 1
+            self.batched_programs += num_programs
+
+    def snapshot(self) -> Dict[str,Any]:
+        with self.lock:
+            uptime = time.perf_counter() - self.started
+            return dict(
+                uptime_secs=uptime,
+                requests=self.requests,
+                programs=self.programs,
+                errors=self.errors,
+                batches=self.batches,
+                mean_batch_programs=self.batched_programs / self.batches if self.batches else 0.,
+                requests_per_sec=self.requests / uptime if uptime > 0 else 0.,
+                latency_ms={k: v * 1000 for k, v in percentiles(list(self.latencies)).items()},
+                peak_rss_mb=peak_rss_mb(),
+            )
+
+class Batcher:
+    """
+    Combines the rewrite requests for one library into micro-batches that are run on a shared Session, see the module docstring
+    """
+    def __init__(self, abstractions: List[Any], kwargs: Dict[str,Any], session: Session, stats: ServerStats, batch_size: int, batch_secs: float):
+        self.abstractions = abstractions
+        self.kwargs = kwargs
+        self.session = session
+        self.stats = stats
+        self.batch_size = batch_size
+        self.batch_secs = batch_secs
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.loop, daemon=True, name="stitch_batcher")
+        self.thread.start()
+
+    def submit(self, programs: List[str]) -> "Future[List[str]]":
+        """Queues programs to be rewritten in the next batch, returning a Future for the rewritten programs"""
+        future = Future()
+        if len(programs) == 0:
+            # the backend's rewriter can't take an empty corpus, and there's nothing to rewrite anyways
+            future.set_result([])
+            return future
+        self.queue.put((programs, future))
+        return future
+
+    def loop(self):
+        while True:
+            first = self.queue.get()
+            if first is None:
+                return
+            batch = [first]
+            size = len(first[0])
+            deadline = time.perf_counter() + self.batch_secs
+            while size < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(0., deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.queue.put(None) # stop after this batch
+                    break
+                batch.append(item)
+                size += len(item[0])
+            self.stats.batch(size)
+            self.session.submit(self.run_batch, batch).add_done_callback(lambda done, batch=batch: self.fail_batch(batch, done.exception()))
+
+    def run_batch(self, batch: List[Tuple[List[str],Future]]):
+        if len(self.abstractions) == 0:
+            # the backend's rewriter can't take an empty library, and there's nothing to rewrite with anyways
+            for programs, future in batch:
+                future.set_result(programs)
+            return
+        try:
+            rewritten = rewrite([p for programs, _ in batch for p in programs], self.abstractions, outputs={"rewritten"}, **self.kwargs).rewritten
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            for item in batch:
+                self.run_batch([item]) # so that only the bad request fails
+            return
+        start = 0
+        for programs, future in batch:
+            future.set_result(rewritten[start:start + len(programs)])
+            start += len(programs)
+
+    def fail_batch(self, batch: List[Tuple[List[str],Future]], error: Union[BaseException,None]):
+        """Fails the requests that run_batch() left unanswered if it raised, so that nobody waits on them forever"""
+        if error is None:
+            return
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+class RewriteServer:
+    """
+    The libraries and worker pool behind a server, independent of how requests arrive
+
+    :param libraries: the abstractions and rewrite() kwargs of each library by name, as from stitch_core.cli.load_rewrite_library()
+    :type libraries: Dict[str,Tuple[List[Abstraction],Dict[str,Any]]]
+    :param threads: the number of batches to rewrite at once
+    :type threads: int
+    :param batch_size: the most programs to put in one batch
+    :type batch_size: int
+    :param batch_ms: how long the first request of a batch waits for others to join it
+    :type batch_ms: float
+    """
+    def __init__(self, libraries: Dict[str,Tuple[List[Any],Dict[str,Any]]], threads: int = 1, batch_size: int = 256, batch_ms: float = 2.):
+        assert len(libraries) > 0, "at least one library is needed"
+        self.session = Session(threads)
+        self.stats = ServerStats()
+        self.batchers = {name: Batcher(abstractions, kwargs, self.session, self.stats, batch_size, batch_ms / 1000)
+                         for name, (abstractions, kwargs) in libraries.items()}
+
+    def rewrite(self, programs: List[str], library: Union[str,None] = None) -> List[str]:
+        """
+        Rewrites programs with a library (which can be left out if there's only one), waiting for the batch they end up in
+
+        :raises KeyError: If there's no library by that name.
+        :raises StitchException: If the backend panicked on one of the programs.
+        """
+        start = time.perf_counter()
+        if library is None and len(self.batchers) == 1:
+            library, = self.batchers
+        if library not in self.batchers:
+            raise KeyError(f"no library named {library!r}, the libraries are {sorted(self.batchers)}")
+        ok = False
+        try:
+            res = self.batchers[library].submit(programs).result()
+            ok = True
+            return res
+        finally:
+            self.stats.request(len(programs), time.perf_counter() - start, ok)
+
+    def libraries(self) -> Dict[str,int]:
+        return {name: len(batcher.abstractions) for name, batcher in self.batchers.items()}
+
+    def close(self):
+        for batcher in self.batchers.values():
+            batcher.close()
+        self.session.close()
+
+class RewriteHandler(BaseHTTPRequestHandler):
+    """
+    Serves the endpoints in the module docstring for the ``rewrite_server`` of the HTTP server it's attached to
+    """
+    protocol_version = "HTTP/1.1" # keep connections alive between requests
+
+    def setup(self):
+        super().setup()
+        if self.connection.family != socket.AF_UNIX:
+            # the headers and body are written separately, which Nagle's algorithm would hold up until the client acks
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.reply(200, dict(self.server.rewrite_server.stats.snapshot(), utilization=self.server.rewrite_server.session.utilization))
+        elif self.path == "/libraries":
+            self.reply(200, self.server.rewrite_server.libraries())
+        else:
+            self.reply(404, dict(error=f"no endpoint {self.path}"))
+
+    def do_POST(self):
+        if self.path != "/rewrite":
+            self.reply(404, dict(error=f"no endpoint {self.path}"))
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            programs = request["programs"]
+            assert isinstance(programs, list) and all(isinstance(p, str) for p in programs), "programs must be a list of strings"
+            library = request.get("library")
+            assert library is None or isinstance(library, str), "library must be a string"
+        except (ValueError, KeyError, TypeError, AssertionError) as e:
+            self.reply(400, dict(error=f"bad request: {e}"))
+            return
+        try:
+            self.reply(200, dict(rewritten=self.server.rewrite_server.rewrite(programs, library)))
+        except KeyError as e:
+            self.reply(404, dict(error=e.args[0]))
+        except Exception as e:
+            self.reply(500, dict(error=str(e)))
+
+    def reply(self, status: int, body: Any):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self) -> str:
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        pass # a line per request would swamp the output
+
+# the default backlog of 5 refuses connections when many clients connect at once
+LISTEN_BACKLOG = 128
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = LISTEN_BACKLOG
+
+class ThreadingLocalHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = LISTEN_BACKLOG
+
+def make_server(rewrite_server: RewriteServer, port: int = 8765, unix: Union[str,None] = None) -> Union[ThreadingLocalHTTPServer,ThreadingUnixHTTPServer]:
+    """
+    An HTTP server for a RewriteServer, listening on ``unix`` if given and otherwise on localhost at ``port`` (0 picks a free port).
+    Call ``serve_forever()`` on it to start serving. A socket already at ``unix`` (say from a server that didn't shut down cleanly) is replaced.
+
+    :raises FileExistsError: If something other than a socket is at ``unix``.
+    """
+    if unix is not None:
+        try:
+            mode = os.stat(unix).st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise FileExistsError(f"{unix} already exists and isn't a socket")
+            os.remove(unix)
+        server = ThreadingUnixHTTPServer(unix, RewriteHandler)
+    else:
+        server = ThreadingLocalHTTPServer(("127.0.0.1", port), RewriteHandler)
+    server.rewrite_server = rewrite_server
+    return server
+
+class UnixHTTPConnection(HTTPConnection):
+    """
+    An HTTPConnection over a Unix socket, for talking to a server started with ``--unix``
+    """
+    def __init__(self, path: str, timeout: float = 60.):
+        super().__init__("localhost", timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+def connect(address: str, timeout: float = 60.) -> HTTPConnection:
+    """
+    Opens a connection to a server at an address like "127.0.0.1:8765" or "unix:/tmp/stitch.sock"
+    """
+    if address.startswith("unix:"):
+        return UnixHTTPConnection(address[len("unix:"):], timeout)
+    host, port = address.rsplit(":", 1)
+    return HTTPConnection(host, int(port), timeout=timeout)
+
+def call(conn: HTTPConnection, method: str, path: str, body: Any = None) -> Tuple[int,Any]:
+    """
+    Makes a request on a connection from connect(), returning the status and the decoded json response
+    """
+    # as bytes the body is sent along with the headers, rather than after them where it would wait on a delayed ack
+    conn.request(method, path, body=None if body is None else json.dumps(body).encode(), headers={"Content-Type": "application/json"})
+    response = conn.getresponse()
+    return response.status, json.loads(response.read())
+
+def main(argv: Union[List[str],None] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m stitch_core.serve", description="Serve rewrite() with preloaded libraries over local HTTP or a Unix socket")
+    parser.add_argument("--library", action="append", required=True, help="name=path of a library to load, can be given more than once")
+    parser.add_argument("--port", type=int, default=8765, help="the localhost port to listen on")
+    parser.add_argument("--unix", help="listen on this Unix socket instead of a port")
+    parser.add_argument("--threads", type=int, default=1, help="number of batches to rewrite at once")
+    parser.add_argument("--batch-size", type=int, default=256, help="the most programs to put in one batch")
+    parser.add_argument("--batch-ms", type=float, default=2., help="how long a batch waits for more requests to join it")
+    args = parser.parse_args(argv)
+
+    libraries = {}
+    for spec in args.library:
+        name, sep, path = spec.partition("=")
+        if not sep:
+            parser.error(f"--library should look like name=path, not {spec!r}")
+        libraries[name] = load_rewrite_library(path)
+
+    rewrite_server = RewriteServer(libraries, args.threads, args.batch_size, args.batch_ms)
+    server = make_server(rewrite_server, args.port, args.unix)
+    where = args.unix or f"127.0.0.1:{server.server_address[1]}"
+    print(f"serving {', '.join(f'{name} ({n} abstractions)' for name, n in rewrite_server.libraries().items())} on {where}", file=sys.stderr, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        rewrite_server.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+"""
+Sweeps compress() over a grid of search settings on one corpus, to see how it scales with ``threads`` and which of
+``batch``, ``dynamic_batch``, ``inv_candidates``, ``hole_choice`` and the ``no_opt_*`` pruning ablations pay off.
+
+Each setting is run ``--repeat`` times. None of these settings should change which abstractions are found (the prunings
+are sound and the top abstraction is globally optimal), so the utility and final cost of every learned abstraction must be
+the same in every run, and any setting that disagrees with the first one is reported.
+
+For each setting the mean and standard deviation of the compress time are reported, along with the speedup and parallel
+efficiency relative to the run of the same setting with the fewest threads.
+
+Typical usage from the root of the repo::
+
+    python -m stitch_core.sweep nuts-bolts --threads 1 2 4 8 --batch 1 8 --dynamic-batch off on --repeat 3 --out sweep.json
+    python -m stitch_core.sweep my_programs.json --threads 4 --no-opt upper_bound useless_abstract force_multiuse
+
+The corpus is either the name of a corpus bundled in ``data/`` (see stitch_core.bench) or the path to a json file holding a
+list of programs or a DreamCoder-format frontiers file. The process exits with a nonzero status if any setting's results differ.
+"""
+from stitch_core import compress, from_dreamcoder
+from stitch_core.bench import DEFAULT_DATA_DIR, load_corpus
+from typing import Dict, List, Any, Union
+import argparse
+import itertools
+import json
+import os
+import statistics
+import sys
+import time
+
+SETTING_KEYS = ["threads", "batch", "dynamic_batch", "inv_candidates", "hole_choice", "no_opt"]
+
+def load_input(corpus: str, data_dir: str) -> Dict[str,Any]:
+    """
+    Loads a corpus as a dictionary of kwargs for compress(), either from a json file or by the name of a bundled corpus
+    """
+    if not os.path.exists(corpus):
+        return load_corpus(corpus, data_dir)
+    with open(corpus) as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        return from_dreamcoder(data)
+    return dict(programs=data)
+
+def settings_grid(threads: List[int], batch: List[int], dynamic_batch: List[bool], inv_candidates: List[int], hole_choice: List[str], no_opt: List[Union[str,None]]) -> List[Dict[str,Any]]:
+    """
+    Every combination of the given values, as a list of settings dictionaries. A ``no_opt`` of None runs with all optimizations
+    on, while a ``no_opt`` like "upper_bound" turns on ``no_opt_upper_bound``.
+    """
+    return [dict(zip(SETTING_KEYS, values)) for values in itertools.product(threads, batch, dynamic_batch, inv_candidates, hole_choice, no_opt)]
+
+def setting_kwargs(setting: Dict[str,Any]) -> Dict[str,Any]:
+    """
+    The compress() kwargs for a settings dictionary
+    """
+    kwargs = {k: v for k, v in setting.items() if k != "no_opt"}
+    if setting["no_opt"] is not None:
+        kwargs[f"no_opt_{setting['no_opt']}"] = True
+    return kwargs
+
+def describe(setting: Dict[str,Any]) -> str:
+    return " ".join(f"{k}={setting[k]}" for k in SETTING_KEYS)
+
+def run_setting(corpus: Dict[str,Any], setting: Dict[str,Any], iterations: int, max_arity: int) -> Dict[str,Any]:
+    """
+    Runs compress() once with a setting, recording its time and the utility and final cost of each abstraction it learned
+    """
+    start = time.perf_counter()
+    res = compress(**corpus, iterations=iterations, max_arity=max_arity, **setting_kwargs(setting))
+    secs = time.perf_counter() - start
+    return dict(
+        setting,
+        compress_secs=secs,
+        results=[[a["utility"], a["final_cost"]] for a in res.json["abstractions"]],
+    )
+
+def summarize(records: List[Dict[str,Any]]) -> List[Dict[str,Any]]:
+    """
+    Groups the records of repeated runs by setting, giving the mean, standard deviation and minimum compress time of each.
+    Each setting also gets a ``speedup`` and ``efficiency`` (speedup divided by the increase in threads) relative to the
+    setting that only differs from it in having the fewest threads.
+    """
+    groups: Dict[str,List[Dict[str,Any]]] = {}
+    for r in records:
+        groups.setdefault(describe(r), []).append(r)
+
+    rows = []
+    for group in groups.values():
+        secs = [r["compress_secs"] for r in group]
+        rows.append(dict(
+            {k: group[0][k] for k in SETTING_KEYS},
+            runs=len(secs),
+            mean_secs=statistics.mean(secs),
+            stdev_secs=statistics.stdev(secs) if len(secs) > 1 else 0.,
+            min_secs=min(secs),
+        ))
+
+    for row in rows:
+        base = min((other for other in rows if all(other[k] == row[k] for k in SETTING_KEYS if k != "threads")), key=lambda other: other["threads"])
+        row["speedup"] = base["mean_secs"] / row["mean_secs"]
+        row["efficiency"] = row["speedup"] * base["threads"] / row["threads"]
+    return rows
+
+def find_mismatches(records: List[Dict[str,Any]]) -> List[str]:
+    """
+    Describes each setting that learned abstractions with a different utility or final cost than the first run did
+    """
+    mismatched = []
+    for r in records:
+        if r["results"] != records[0]["results"] and describe(r) not in mismatched:
+            mismatched.append(describe(r))
+    return mismatched
+
+def main(argv: Union[List[str],None] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m stitch_core.sweep", description="Sweep compress() over a grid of search settings on a corpus")
+    parser.add_argument("corpus", help="a bundled corpus like `nuts-bolts` or `origami_2`, or a json file of programs or DreamCoder frontiers")
+    parser.add_argument("--data", default=DEFAULT_DATA_DIR, help="the repo's data/ directory")
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument("--max-arity", type=int, default=2)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--batch", type=int, nargs="+", default=[1])
+    parser.add_argument("--dynamic-batch", choices=["off", "on"], nargs="+", default=["off"])
+    parser.add_argument("--inv-candidates", type=int, nargs="+", default=[1])
+    parser.add_argument("--hole-choice", nargs="+", default=["depth-first"])
+    parser.add_argument("--no-opt", nargs="*", default=[], help="also run with each of these optimizations turned off, like `upper_bound` for no_opt_upper_bound")
+    parser.add_argument("--repeat", type=int, default=3, help="number of times to run each setting")
+    parser.add_argument("--out", help="write the results to this json file")
+    args = parser.parse_args(argv)
+
+    corpus = load_input(args.corpus, args.data)
+    grid = settings_grid(args.threads, args.batch, [d == "on" for d in args.dynamic_batch], args.inv_candidates, args.hole_choice, [None] + args.no_opt)
+
+    records = []
+    for setting in grid:
+        for _ in range(args.repeat):
+            records.append(run_setting(corpus, setting, args.iterations, args.max_arity))
+
+    rows = summarize(records)
+    mismatches = find_mismatches(records)
+    print(f"{'threads':>8}{'batch':>7}{'dynamic':>9}{'inv':>5}  {'hole_choice':<20}{'no_opt':<18}{'mean':>9}{'stdev':>9}{'speedup':>9}{'eff':>6}  ok")
+    for row in rows:
+        ok = describe(row) not in mismatches
+        print(f"{row['threads']:>8}{row['batch']:>7}{'on' if row['dynamic_batch'] else 'off':>9}{row['inv_candidates']:>5}  {row['hole_choice']:<20}{row['no_opt'] or '-':<18}{row['mean_secs']:>8.3f}s{row['stdev_secs']:>8.3f}s{row['speedup']:>8.2f}x{row['efficiency']:>6.2f}  {'yes' if ok else 'NO'}")
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(dict(corpus=args.corpus, iterations=args.iterations, max_arity=args.max_arity, cpu_count=os.cpu_count(), settings=rows, mismatches=mismatches, records=records), f, indent=4)
+        print(f"wrote {args.out}")
+
+    for mismatch in mismatches:
+        print(f"results differ from {describe(records[0])} for: {mismatch}")
+    return 1 if mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
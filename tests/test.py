@@ -1,90 +1,539 @@
-from stitch_core import compress, rewrite, StitchException, from_dreamcoder, Abstraction, name_mapping_stitch, stitch_to_dreamcoder
+from stitch_core import compress, RewritePool, TdfaGrammar, bulk_list, task_list, CompressionResult, encode_binary, decode_binary, save_library, load_library, compress_many, CompressJob, Session, rewrite, peak_rss_mb, inline, verify, merge_libraries, prune, StitchException, from_dreamcoder, Abstraction, name_mapping_stitch, stitch_to_dreamcoder
+from stitch_core.bench import find_regressions, find_cases, run_isolated, main as bench_main
+from stitch_core.cli import main as cli_main, rewrite_chunks, load_rewrite_library
+from stitch_core.serve import RewriteServer, make_server, connect, call, percentiles
+from stitch_core.sweep import settings_grid, summarize, find_mismatches
 import json
 import math
+import pathlib
+import pickle
+import subprocess
+import sys
+import tempfile
+import threading
 
-# simple test
-programs = ["(a a a)", "(b b b)"]
-res = compress(programs, iterations=1)
-assert res.rewritten == ['(fn_0 a)', '(fn_0 b)']
-assert res.abstractions[0].body == '(#0 #0 #0)'
-
-# rewriting test
-programs_to_rewrite = ["(c c c)", "(d d d)"]
-rw = rewrite(programs_to_rewrite, res.abstractions)
-assert rw.rewritten == ['(fn_0 c)', '(fn_0 d)']
-assert stitch_to_dreamcoder(rw.rewritten, name_mapping_stitch(res.json)) == ['(#(lambda ($0 $0 $0)) c)', '(#(lambda ($0 $0 $0)) d)']
-
-# example from Overview section of the Stitch paper (https://arxiv.org/abs/2211.16605)
-programs = [
-    "(lam (+ 3 (* (+ 2 4) 2)))",
-    "(lam (map (lam (+ 3 (* 4 (+ 3 $0)))) $0))",
-    "(lam (* 2 (+ 3 (* $0 (+ 2 1)))))"
-]
-res = compress(programs, iterations=1, max_arity=2)
-assert res.abstractions[0].body == '(+ 3 (* #1 #0))'
-assert res.rewritten == [
-    '(lam (fn_0 2 (+ 2 4)))',
-    '(lam (map (lam (fn_0 (+ 3 $0) 4)) $0))',
-    '(lam (* 2 (fn_0 (+ 2 1) $0)))'
+# the process pools start their workers fresh rather than forking, which re-imports this file in each of them
+if __name__ == "__main__":
+    # simple test
+    programs = ["(a a a)", "(b b b)"]
+    res = compress(programs, iterations=1)
+    assert res.rewritten == ['(fn_0 a)', '(fn_0 b)']
+    assert res.abstractions[0].body == '(#0 #0 #0)'
+
+    # rewriting test
+    programs_to_rewrite = ["(c c c)", "(d d d)"]
+    rw = rewrite(programs_to_rewrite, res.abstractions)
+    assert rw.rewritten == ['(fn_0 c)', '(fn_0 d)']
+    assert stitch_to_dreamcoder(rw.rewritten, name_mapping_stitch(res.json)) == ['(#(lambda ($0 $0 $0)) c)', '(#(lambda ($0 $0 $0)) d)']
+
+    # example from Overview section of the Stitch paper (https://arxiv.org/abs/2211.16605)
+    programs = [
+        "(lam (+ 3 (* (+ 2 4) 2)))",
+        "(lam (map (lam (+ 3 (* 4 (+ 3 $0)))) $0))",
+        "(lam (* 2 (+ 3 (* $0 (+ 2 1)))))"
     ]
+    res = compress(programs, iterations=1, max_arity=2)
+    assert res.abstractions[0].body == '(+ 3 (* #1 #0))'
+    assert res.rewritten == [
+        '(lam (fn_0 2 (+ 2 4)))',
+        '(lam (map (lam (fn_0 (+ 3 $0) 4)) $0))',
+        '(lam (* 2 (fn_0 (+ 2 1) $0)))'
+        ]
+
+    # inlining abstractions back into the base DSL
+    assert inline(res.rewritten, res.abstractions) == programs
+    assert inline(res.rewritten, res.abstractions, threads=2) == programs
+    # round-trip verification of rewritten programs
+    assert verify(programs, res.rewritten, res.abstractions, threads=2).ok
+    report = verify(programs, ["(lam (fn_0 2 (+ 2 4)))", "(lam (fn_0 2 2))", res.rewritten[2]], res.abstractions)
+    assert [i for (i, _, _) in report.mismatches] == [1]
+    # ((l 1) t) and (l 1 t) are the same term, and the cogsci programs are full of the former
+    with open('../data/cogsci/bridge.json','r') as f:
+        bridge = json.load(f)[:50]
+    bridge_res = compress(bridge, iterations=2, max_arity=2)
+    assert verify(bridge, bridge_res.rewritten, bridge_res.abstractions).ok
+    assert verify(["((lambda (f $0)) (g 1) x)"], ["((lam (f $0)) ((g 1) x))"], []).ok == False
+    assert verify(["((lambda (f $0)) (g 1) x)"], ["(((lam (f $0)) (g 1)) x)"], []).ok
+    # nested abstractions, shifting under lambdas, and eta-expanding partial applications
+    library = [Abstraction("fn_0", "(lam (f #0 $0))", 1), Abstraction("fn_1", "(g (fn_0 #1) #0)", 2)]
+    assert inline(["(lam (fn_1 $0 x))", "(fn_0 (h $0) y)", "(map fn_0 xs)"], library) == [
+        "(lam (g (lam (f x $0)) $0))",
+        "((lam (f (h $1) $0)) y)",
+        "(map (lam (lam (f $1 $0))) xs)",
+    ]
+    # an abstraction passed to a higher-order abstraction is inlined where it gets applied, without leaving a beta-redex
+    library = [Abstraction("fn_0", "(+ 1 #0)", 1), Abstraction("fn_1", "(#0 (#0 #1))", 2), Abstraction("fn_2", "(fn_1 (* #0) y)", 1)]
+    assert inline(["(fn_1 fn_0 x)", "(fn_1 (fn_1 fn_0) x)", "(fn_2 2)"], library) == ["(+ 1 (+ 1 x))", "(+ 1 (+ 1 (+ 1 (+ 1 x))))", "(* 2 (* 2 y))"]
+
+    # loading from a file
+    with open('../data/cogsci/nuts-bolts.json','r') as f:
+        programs = json.load(f)
+    res = compress(programs, iterations=3, max_arity=3)
+    assert res.abstractions[0].body == '(T (repeat (T l (M 1 0 -0.5 (/ 0.5 (tan (/ pi #1))))) #1 (M 1 (/ (* 2 pi) #1) 0 0)) (M #0 0 0 0))'
+    assert res.abstractions[1].body == '(repeat (T (T #2 (M 0.5 0 0 0)) (M 1 0 (* #1 (cos (/ pi 4))) (* #1 (sin (/ pi 4))))) #0 (M 1 (/ (* 2 pi) #0) 0 0))'
+    assert res.abstractions[2].body == '(T (T c (M 2 0 0 0)) (M #0 0 0 0))'
+
+    # pruning recomputes the utility of each abstraction on the final corpus, which matches compress() when nothing was subsumed
+    assert [a["marginal_utility"] for a in prune(res).json["abstractions"]] == [a["utility"] for a in res.json["abstractions"]]
+    pruned = prune(res, min_uses=180)
+    assert [a["name"] for a in pruned.json["pruned"]] == ["fn_2"]
+    assert [a.name for a in pruned.abstractions] == ["fn_0", "fn_1"]
+    assert verify(programs, pruned.rewritten, pruned.abstractions).ok
+    assert pruned.json["final_cost"] == rewrite(programs, pruned.abstractions).json["final_cost"]
+    try:
+        prune(compress(programs[:5], iterations=1, outputs={"abstractions"}))
+        assert False, "Should have thrown an exception"
+    except ValueError as e:
+        assert '"rewritten"' in str(e)
+
+    # merging the libraries learned on two halves of a corpus
+    half_a = compress(programs[::2], iterations=2, max_arity=3)
+    half_b = compress(programs[1::2], iterations=3, max_arity=3)
+    merged = merge_libraries([half_a, half_b], programs=programs)
+    assert merged.num_duplicates == 2 and len(merged.abstractions) == 3
+    assert merged.renames[1] == {"fn_0": "fn_0", "fn_1": "fn_1", "fn_2": "fn_2"}
+    assert verify(programs, merged.rewrite_result.rewritten, merged.abstractions).ok
+    # duplicates that take their arguments in a different order get their calls reordered
+    merged = merge_libraries([[Abstraction("fn_0", "(f #0 #1)", 2)], [Abstraction("fn_0", "(f #1 #0)", 2), Abstraction("fn_1", "(g (fn_0 x y))", 0)]])
+    assert [a.body for a in merged.abstractions] == ["(f #0 #1)", "(g (fn_0 y x))"]
+    assert merged.translate(["(fn_0 a b)"], 1) == ["(fn_0 b a)"]
+
+    # top-k candidates that the search scored on each iteration
+    res_k = compress(programs, iterations=2, max_arity=2, return_candidates=3)
+    assert [len(c) for c in res_k.candidates] == [3, 3]
+    assert [c[0]["body"] for c in res_k.candidates] == [a.body for a in res_k.abstractions]
+    assert all(c[0]["utility"] >= c[1]["utility"] >= c[2]["utility"] for c in res_k.candidates)
+    # print() from other threads still shows up while the backend's printouts are captured, and doesn't end up in the candidates
+    chatter = """
+import json, sys, threading
+from stitch_core import compress
+original = sys.stdout
+def chatter():
+    while sys.stdout is original: # until the capture starts
+        pass
+    for i in range(20):
+        print(f"chatter {i}")
+thread = threading.Thread(target=chatter)
+thread.start()
+res = compress(json.load(open("../data/cogsci/nuts-bolts.json")), iterations=2, return_candidates=2, detailed_stats=True)
+thread.join()
+print(json.dumps(res.candidates))
+"""
+    out = subprocess.run([sys.executable, "-c", chatter], capture_output=True, text=True, check=True).stdout.splitlines()
+    assert sorted(out[:-1]) == sorted(f"chatter {i}" for i in range(20)) and [len(c) for c in json.loads(out[-1])] == [2, 2]
+
+    # dreamcoder format
+    with open('../data/dc/origami/iteration_0_3.json','r') as f:
+        dreamcoder_json = json.load(f)
+    kwargs = from_dreamcoder(dreamcoder_json)
+    res = compress(**kwargs, iterations=3, max_arity=3)
+    assert res.abstractions[0].body == '(if (empty? (cdr #0)) #2 (#1 (cdr #0)))'
+    assert inline(res.rewritten, res.abstractions) == res.json["original"]
+    assert verify(kwargs["programs"], res.rewritten, res.abstractions).ok
+    # pruning everything gives back the original cost, as long as the tasks are passed along so costs are per task
+    pruned = prune(res, min_uses=10**9, tasks=kwargs["tasks"])
+    assert pruned.abstractions == [] and pruned.json["final_cost"] == pruned.json["original_cost"] and pruned.json["compression_ratio"] == 1.
+    assert verify(kwargs["programs"], pruned.rewritten, pruned.abstractions).ok
+    try:
+        prune(res)
+        assert False
+    except ValueError:
+        pass
+
+
+    # StitchException: passing in an argument that doesn't actually exist
+    try:
+        out_json = compress(programs, iterations=3, nonexistant_arg=213879)
+        assert False, "Should have thrown an exception"
+    except StitchException as e:
+        pass
+
+    # StitchException: malformed programs (or any other panic in the rust backend)
+    bad_programs = ["(a a a"]
+    try:
+        out_json = compress(bad_programs, iterations=3)
+        assert False, "Should have thrown an exception"
+    except StitchException as e:
+        # print(e)
+        pass
+
+    # TypeError: passing in an argument of the wrong type, so that conversion to strongly typed Rust fails
+    bad_programs = 4
+    try:
+        out_json = compress(bad_programs, iterations=3, loud_panic=True)
+        assert False, "Should have thrown an exception"
+    except TypeError as e:
+        # print(e)
+        pass
+
+    # 1x (default) weighting vs 2x weighting vs weighting the "g" programs more
+    programs = ["(f a a)", "(f b b)", "(f c c)", "(g d d)", "(g e e)"]
+    res = compress(programs, iterations=1)
+    res2x = compress(programs, iterations=1, weights=[2. for _ in programs])
+    res_uneven = compress(programs, iterations=1, weights=[1., 1., 1., 2., 2.])
+
+    assert res.json["original_cost"] *2 == res2x.json["original_cost"]
+    assert res.json["final_cost"] *2 == res2x.json["final_cost"]
+    assert res.abstractions[0].body == res2x.abstractions[0].body == "(f #0 #0)"
+    assert res_uneven.abstractions[0].body == "(g #0 #0)"
+
+    # make sure compression ratio is as expected
+    assert math.fabs(res_uneven.json["original_cost"]/res_uneven.json["final_cost"] - res_uneven.json["compression_ratio"]) < 0.00001
+
+    # assert res.rewritten == ['(fn_0 a)', '(fn_0 b)']
+    # assert res.abstractions[0].body == '(#0 #0 #0)'
+
+
+    # per-phase timing and memory telemetry
+    programs = ["(f a a)", "(f b b)", "(f c c)", "(g d d)", "(g e e)"]
+    assert {"args_secs", "backend_secs", "json_decode_secs", "postprocess_secs", "total_secs", "peak_rss_mb"} <= set(compress(programs, iterations=1).stats)
+    assert "backend_secs" in rewrite(programs, res.abstractions).stats
+    res_stats = compress(programs, iterations=2, detailed_stats=True)
+    assert res_stats.stats["iterations"][0]["worklist_steps"] > 0 and "search_ms" in res_stats.stats["iterations"][0]
+
+    # benchmark regression gating
+    baseline = [dict(case="house-a1-i1", threads=1, compress_secs=1.0, rewrite_secs=0.5), dict(case="house-a1-i1", threads=1, compress_secs=1.2, rewrite_secs=0.6)]
+    assert find_regressions([dict(case="house-a1-i1", threads=1, compress_secs=1.1, rewrite_secs=0.5)], baseline, threshold=0.2, min_secs=0.05) == []
+    assert len(find_regressions([dict(case="house-a1-i1", threads=1, compress_secs=1.3, rewrite_secs=0.5)], baseline, threshold=0.2, min_secs=0.05)) == 1
+    assert "rewrite_secs" in find_regressions([dict(case="house-a1-i1", threads=1, compress_secs=1.0, rewrite_secs=0.7)], baseline, threshold=0.2, min_secs=0.05)[0]
+    # a case that can't run is recorded as failed rather than hanging the benchmark
+    with tempfile.TemporaryDirectory() as data_dir:
+        (pathlib.Path(data_dir) / "expected_outputs").mkdir()
+        (pathlib.Path(data_dir) / "expected_outputs" / "missing-a1-i1.json").write_text(json.dumps(dict(abstractions=[])))
+        assert run_isolated(find_cases(data_dir)[0], 1, data_dir)["error"].startswith("FileNotFoundError")
+        assert bench_main(["--data", data_dir]) == 1
+
+    # streaming progress events
+    programs = ["(f a a)", "(f b b)", "(f c c)", "(g d d)", "(g e e)"]
+    batches = []
+    res_events = compress(programs, iterations=3, on_event=batches.append)
+    events = [e for batch in batches for e in batch]
+    assert [e["iteration"] for e in events if e["event"] == "iteration_start"] == [0, 1, 2]
+    chosen = [e["abstraction"] for e in events if e["event"] == "iteration_end"]
+    assert [a["body"] for a in chosen if a is not None] == [a.body for a in res_events.abstractions]
+    assert chosen[-1] is None # nothing compressive left by the last iteration
+    assert [e["utility"] for e in events if e["event"] == "new_best"] == [a["utility"] for a in chosen if a is not None] # one new best per iteration here
+    assert any(e["event"] == "search_stats" and e["worklist_steps"] > 0 for e in events)
+    assert res_events.json["abstractions"] == compress(programs, iterations=3).json["abstractions"]
+    # a callback that prints (even more than a pipe holds) has its output shown rather than captured, and doesn't stall the backend
+    printing = """
+from stitch_core import compress
+def on_event(events):
+    for e in events:
+        print(e["event"] + " " + "x" * 100000)
+compress(["(f a a)", "(f b b)", "(f c c)", "(g d d)", "(g e e)"], iterations=3, on_event=on_event)
+"""
+    out = subprocess.run([sys.executable, "-c", printing], capture_output=True, text=True, check=True, timeout=60).stdout.splitlines()
+    assert [line.split()[0] for line in out] == [e["event"] for e in events]
+
+    # search-parameter sweep summaries
+    grid = settings_grid([1, 4], [1], [False], [1], ["depth-first"], [None, "upper_bound"])
+    assert len(grid) == 4
+    sweep_records = [dict(setting, compress_secs=secs, results=[[100, 50]]) for setting, secs in zip(grid, [2.0, 8.0, 1.0, 6.0])]
+    rows = {(r["threads"], r["no_opt"]): r for r in summarize(sweep_records)}
+    assert rows[(4, None)]["speedup"] == 2.0 and rows[(4, None)]["efficiency"] == 0.5
+    assert math.isclose(rows[(4, "upper_bound")]["speedup"], 8.0 / 6.0)
+    assert find_mismatches(sweep_records) == []
+    sweep_records[3]["results"] = [[90, 60]]
+    assert find_mismatches(sweep_records) == ["threads=4 batch=1 dynamic_batch=False inv_candidates=1 hole_choice=depth-first no_opt=upper_bound"]
+
+    # autotuned search settings
+    programs = ["(f a a)", "(f b b)", "(f c c)", "(g d d)", "(g e e)"]
+    res_tuned = compress(programs, iterations=2, autotune=True)
+    assert res_tuned.json["args"]["autotune"]["threads"] == res_tuned.json["args"]["step"]["threads"] == 1 # far too small a corpus for more threads
+    assert res_tuned.json["args"]["autotune"]["total_nodes"] == 15
+    assert res_tuned.json["abstractions"] == compress(programs, iterations=2).json["abstractions"]
+    res_tuned = compress(programs, iterations=2, autotune="calibrate")
+    assert res_tuned.json["abstractions"] == compress(programs, iterations=2).json["abstractions"]
+
+    # search on a sample then rewrite everything
+    programs = ["(f a a)", "(f b b)", "(f c c)", "(f d d)", "(g e e)", "(g h h)", "(g i i)", "(g j j)"]
+    tasks = ["t0", "t0", "t1", "t1", "t2", "t2", "t3", "t3"]
+    res_sample = compress(programs, iterations=1, sample=4, sample_by="task", tasks=tasks)
+    assert res_sample.json["sample"]["num_programs"] == 4 # one from each task
+    assert res_sample.abstractions[0].body == "(f #0 #0)"
+    assert len(res_sample.rewritten) == len(programs)
+    assert res_sample.json["original_cost"] == compress(programs, iterations=1, tasks=tasks).json["original_cost"]
+    assert res_sample.json["final_cost"] < res_sample.json["original_cost"]
+    assert res_sample.json["final_cost"] == compress(programs, iterations=1, tasks=tasks).json["final_cost"] # same abstraction as searching everything
+    assert compress(programs, iterations=1, sample=2).json["sample"]["num_programs"] == 2
+    res_full = compress(programs, iterations=1, sample=1.0)
+    assert res_full.json["sample"]["num_programs"] == len(programs) and res_full.json["final_cost"] == compress(programs, iterations=1).json["final_cost"]
+    # costs come from the backend's rewrite unless weights or primitive costs mean they have to be recomputed
+    for cost_kwargs in (dict(weights=[2.] * len(programs)), dict(cost_prim='{"f":7}')):
+        res_full = compress(programs, iterations=1, sample=1.0, **cost_kwargs)
+        res_all = compress(programs, iterations=1, **cost_kwargs)
+        assert (res_full.json["original_cost"], res_full.json["final_cost"]) == (res_all.json["original_cost"], res_all.json["final_cost"])
+
+    # early stopping between iterations
+    programs = ["(f a a)", "(f b b)", "(f c c)", "(g d d)", "(g e e)"]
+    assert compress(programs, iterations=1).json["stop_reason"] == "iterations"
+    assert compress(programs, iterations=5).json["stop_reason"] == "no_compressive_abstraction"
+    res_all = compress(programs, iterations=5, rewritten_intermediates=True)
+    res_stepwise = compress(programs, iterations=5, rewritten_intermediates=True, max_secs=60)
+    assert res_stepwise.json["stop_reason"] == "no_compressive_abstraction"
+    assert {k: v for k, v in res_stepwise.json.items() if k != "stats"} == {k: v for k, v in res_all.json.items() if k != "stats"}
+    res_stop = compress(programs, iterations=5, min_utility=150)
+    assert res_stop.json["stop_reason"] == "min_utility" and [a.body for a in res_stop.abstractions] == ["(f #0 #0)"]
+    assert res_stop.rewritten == rewrite(programs, res_stop.abstractions).rewritten and res_stop.json["final_cost"] == res_all.json["abstractions"][0]["final_cost"]
+    res_stop = compress(programs, iterations=5, min_ratio_gain=0.5)
+    assert res_stop.json["stop_reason"] == "min_ratio_gain" and res_stop.abstractions == [] and res_stop.rewritten == programs
+    assert res_stop.json["compression_ratio"] == 1.
+    assert compress(programs, iterations=5, max_secs=0).json["stop_reason"] == "max_secs"
+
+    # memory-capped compression, where the uncapped search on house.json peaks at over 500MB
+    with open("../data/cogsci/house.json", "r") as f:
+        house = json.load(f)
+    res_capped = compress(house, iterations=1, max_arity=2, max_memory_mb=200)
+    assert res_capped.json["memory"]["peak_mb"] < 200
+    assert res_capped.json["memory"]["limited"] and res_capped.json["sample"]["num_programs"] < len(house)
+    assert len(res_capped.rewritten) == len(house) and res_capped.json["final_cost"] < res_capped.json["original_cost"]
+    assert peak_rss_mb() < 200 # the search and rewriting ran in a child process
+    res_uncapped = compress(programs, iterations=2, max_memory_mb=200)
+    assert not res_uncapped.json["memory"]["limited"] and res_uncapped.json["abstractions"] == compress(programs, iterations=2).json["abstractions"]
+    # the cap is on the child's own memory, not whatever the caller has resident, and the child can be started from a threaded process
+    ballast = b"x" * (300 * 1024 * 1024)
+    with Session(2) as session:
+        res_uncapped = session.compress(programs, iterations=2, max_memory_mb=250)
+    assert not res_uncapped.json["memory"]["limited"] and res_uncapped.json["memory"]["peak_mb"] < 100
+    del ballast
+
+    # many compressions on a shared pool
+    jobs = [CompressJob(["(f a a)", "(f b b)", "(g c c)"], 1), CompressJob(["(a a a"], 3), CompressJob(programs, 2, threads=2)]
+    results = compress_many(jobs, threads=2)
+    assert results[0].abstractions[0].body == "(f #0 #0)"
+    assert isinstance(results[1], StitchException) # unbalanced parens, which doesn't stop the other jobs
+    assert results[2].json["abstractions"] == compress(programs, iterations=2).json["abstractions"]
+
+    # persistent worker pool
+    with Session(threads=2) as session:
+        assert session.compress(programs, 2).json["abstractions"] == compress(programs, iterations=2).json["abstractions"]
+        futures = [session.submit_compress(programs, 1) for _ in range(4)] + [session.submit_rewrite(programs, res_events.abstractions)]
+        assert all(f.result().rewritten == futures[0].result().rewritten for f in futures[:4])
+        assert futures[-1].result().rewritten == rewrite(programs, res_events.abstractions).rewritten
+        assert session.submit(sorted, [3, 1, 2], reverse=True).result() == [3, 2, 1]
+        assert session.size == 2 and session.utilization["calls"] == 7 and session.utilization["active"] == 0
+        assert 0 < session.utilization["utilization"] <= 1
+    try:
+        session.compress(programs, 1)
+        assert False, "Should have thrown an exception"
+    except RuntimeError:
+        pass # the session is closed
+
+    # selecting output sections
+    res_lib = compress(programs, iterations=2, outputs={"abstractions"})
+    assert res_lib.rewritten is None and "original" not in res_lib.json and "uses" not in res_lib.json["abstractions"][0]
+    assert [a.body for a in res_lib.abstractions] == [a.body for a in compress(programs, iterations=2).abstractions]
+    res_lib = compress(programs, iterations=2, outputs=["rewritten", "intermediates"], min_utility=0)
+    assert res_lib.rewritten == compress(programs, iterations=2).rewritten and len(res_lib.json["abstractions"][0]["rewritten"]) == len(programs)
+    assert "uses" not in rewrite(programs, res_lib.abstractions, outputs={"rewritten"}).json["abstractions"][0]
+    try:
+        rewrite(programs, res_lib.abstractions, outputs={"rewriten"})
+        assert False, "Should have thrown an exception"
+    except AssertionError as e:
+        assert "rewriten" in str(e)
+
+    # bulk input from a newline-delimited buffer or file
+    programs = ["(f a a)", "(f b b)", "(f c c)", "(g d d)", "(g e e)"]
+    buffer = "\n".join(programs).encode()
+    res_list = compress(programs, iterations=2, tasks=["t0", "t0", "t1", "t1", "t2"], weights=[1., 2., 1., 1., 1.])
+    with tempfile.TemporaryDirectory() as tmp:
+        path = pathlib.Path(tmp) / "programs.txt"
+        path.write_bytes(buffer + b"\n")
+        (pathlib.Path(tmp) / "tasks.txt").write_text("t0\nt0\nt1\nt1\nt2\n")
+        res_path = compress(path, iterations=2, tasks=pathlib.Path(tmp) / "tasks.txt", weights=b"1\n2\n1\n1\n1")
+        assert rewrite(path, res_list.abstractions).rewritten == rewrite(programs, res_list.abstractions).rewritten
+        (pathlib.Path(tmp) / "empty.txt").write_bytes(b"")
+        assert bulk_list(pathlib.Path(tmp) / "empty.txt") == []
+    assert res_path.json == {**res_list.json, "stats": res_path.json["stats"]}
+    assert compress(memoryview(buffer), iterations=2).json["abstractions"] == compress(programs, iterations=2).json["abstractions"]
+    assert bulk_list(b"(a b)\r\n(c d)\r\n") == ["(a b)", "(c d)"] and bulk_list(programs) is programs
+
+    # integer task ids
+    assert compress(programs, iterations=2, tasks=[0, 0, 1, 1, 2], task_names=["t0", "t1", "t2"], weights=[1., 2., 1., 1., 1.]).json["abstractions"] == res_list.json["abstractions"]
+    assert compress(programs, iterations=2, tasks=[7, 7, 3, 3, 5], task_names={7: "t0", 3: "t1", 5: "t2"}, weights=[1., 2., 1., 1., 1.]).json["abstractions"] == res_list.json["abstractions"]
+    assert task_list([2, 1, 2]) == ["2", "1", "2"] and task_list(["a", "b"]) == ["a", "b"]
+    for ids in ([0, 3], [-1, 0]):
+        try:
+            task_list(ids, ["t0", "t1"])
+            assert False, "Should have thrown an exception"
+        except ValueError:
+            pass
+
+    # streaming rewrite from the command line
+    programs = ["(f a a)", "(f b b)", "(f c c)", "(g d d)", "(g e e)"] * 7
+    res_lib = compress(programs, iterations=2)
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        (tmp / "lib.json").write_text(json.dumps(res_lib.json))
+        (tmp / "programs.jsonl").write_text("".join(json.dumps(p) + "\n" for p in programs))
+        assert cli_main(["rewrite", "--library", str(tmp / "lib.json"), "--in", str(tmp / "programs.jsonl"), "--out", str(tmp / "out.jsonl"), "--threads", "2", "--chunk-size", "3"]) == 0
+        assert [json.loads(line) for line in (tmp / "out.jsonl").read_text().splitlines()] == rewrite(programs, res_lib.abstractions).rewritten
+        (tmp / "lib.json").write_text(json.dumps([]))
+        assert cli_main(["rewrite", "--library", str(tmp / "lib.json"), "--in", str(tmp / "programs.jsonl"), "--out", str(tmp / "out.jsonl")]) == 0
+        assert [json.loads(line) for line in (tmp / "out.jsonl").read_text().splitlines()] == programs
+    assert list(rewrite_chunks([programs[:3], programs[3:]], res_lib.abstractions, threads=1)) == [res_lib.rewritten[:3], res_lib.rewritten[3:]]
+
+    # compress from the command line
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        (tmp / "programs.txt").write_text("\n".join(programs) + "\n")
+        assert cli_main(["compress", str(tmp / "programs.txt"), "--iterations", "2", "--out", str(tmp / "res.json"), "--outputs", "rewritten"]) == 0
+        res_cli = json.loads((tmp / "res.json").read_text())
+        assert res_cli["abstractions"] == compress(programs, iterations=2, outputs=["rewritten"]).json["abstractions"] and res_cli["rewritten"] == res_lib.rewritten
+        assert "load_secs" in res_cli["stats"] and "original" not in res_cli
+        # with --out - only the result goes to stdout, even with the backend's progress turned on
+        out = subprocess.run([sys.executable, "-m", "stitch_core", "compress", str(tmp / "programs.txt"), "--iterations", "2", "--verbose", "--out", "-"], capture_output=True, check=True)
+        assert [a["body"] for a in json.loads(out.stdout)["abstractions"]] == [a["body"] for a in res_cli["abstractions"]] and "Iteration" in out.stderr.decode()
+        out = subprocess.run([sys.executable, "-m", "stitch_core", "compress", str(tmp / "programs.txt"), "--iterations", "2", "--format", "binary", "--out", "-"], capture_output=True, check=True)
+        assert [a["body"] for a in decode_binary(out.stdout)["abstractions"]] == [a["body"] for a in res_cli["abstractions"]]
+        assert cli_main(["compress", "../data/dc/logo_iteration_1.json", "--iterations", "1", "--out", str(tmp / "res.json")]) == 0
+        with open("../data/dc/logo_iteration_1.json") as f:
+            assert json.loads((tmp / "res.json").read_text())["abstractions"] == compress(**from_dreamcoder(json.load(f)), iterations=1).json["abstractions"]
+
+    # saving results and libraries
+    res_save = compress(programs, iterations=2, rewritten_intermediates=True, return_candidates=2)
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = pathlib.Path(tmp)
+        for format in ("binary", "json"):
+            res_save.save(tmp / "res", format=format)
+            for use_mmap in (False, True):
+                assert json.dumps(CompressionResult.load(tmp / "res", use_mmap=use_mmap).json) == json.dumps(res_save.json)
+        save_library(res_save.abstractions, tmp / "lib")
+        assert [(a.name, a.body, a.arity) for a in load_library(tmp / "lib")] == [(a.name, a.body, a.arity) for a in res_save.abstractions]
+        assert [a.body for a in load_library(tmp / "res")] == [a.body for a in res_save.abstractions]
+        assert [a.body for a in load_rewrite_library(tmp / "res")[0]] == [a.body for a in res_save.abstractions] and load_rewrite_library(tmp / "lib")[1] == {}
+        (tmp / "programs.jsonl").write_text("".join(json.dumps(p) + "\n" for p in programs))
+        assert cli_main(["rewrite", "--library", str(tmp / "lib"), "--in", str(tmp / "programs.jsonl"), "--out", str(tmp / "out.jsonl")]) == 0
+        assert [json.loads(line) for line in (tmp / "out.jsonl").read_text().splitlines()] == res_save.rewritten
+    with open("../data/expected_outputs/house-a1-i1.json") as f:
+        expected = json.load(f)
+    assert len(encode_binary(expected)) < len(json.dumps(expected, indent=4)) / 10 and decode_binary(encode_binary(expected)) == expected
+    rw_save = rewrite(programs, res_save.abstractions)
+    assert decode_binary(encode_binary(rw_save.json, compression_level=0)) == rw_save.json
+    value = {"a": [1, -0.0, 2**70, -2**63, None, True, False, "", ("t",)], "": {"b  c": "é\n"}}
+    assert json.dumps(decode_binary(encode_binary(value))) == json.dumps(value)
+    try:
+        decode_binary(b"[1, 2]")
+        assert False, "Should have thrown an exception"
+    except ValueError:
+        pass
+
+    # pickling results between processes
+    res_pickled = pickle.loads(pickle.dumps(res_save))
+    assert isinstance(res_pickled, CompressionResult) and json.dumps(res_pickled.json) == json.dumps(res_save.json)
+    assert res_pickled.abstractions == res_save.abstractions and res_pickled.rewritten == res_save.rewritten
+    assert len(pickle.dumps(res_capped)) < len(pickle.dumps(res_capped.json)) / 5
+    assert pickle.loads(pickle.dumps(rw_save)).json == rw_save.json
+    assert {res_save.abstractions[0]: "first"}[Abstraction("fn_0", res_save.abstractions[0].body, res_save.abstractions[0].arity)] == "first"
+    assert res_save.abstractions[0] != res_save.abstractions[1] and len(set(res_save.abstractions + res_pickled.abstractions)) == 2
+    assert not hasattr(res_save.abstractions[0], "__dict__")
+
+    # rewrite server with micro-batching
+    rewrite_server = RewriteServer({"lib": (res_save.abstractions, {})}, threads=2, batch_ms=50)
+    server = make_server(rewrite_server, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    address = f"127.0.0.1:{server.server_address[1]}"
+    def post(body):
+        conn = connect(address)
+        responses.append(call(conn, "POST", "/rewrite", body))
+        conn.close()
+    responses = []
+    clients = [threading.Thread(target=post, args=(dict(programs=[p]),)) for p in programs[:8]] + [threading.Thread(target=post, args=(dict(programs=["(f a"]),))]
+    for t in clients:
+        t.start()
+    for t in clients:
+        t.join()
+    assert sorted(r["rewritten"] for status, r in responses if status == 200) == sorted([r] for r in res_save.rewritten[:8])
+    assert [status for status, _ in responses].count(500) == 1 # only the unparseable program fails
+    conn = connect(address)
+    assert call(conn, "POST", "/rewrite", dict(library="lib", programs=programs)) == (200, dict(rewritten=res_save.rewritten))
+    assert call(conn, "POST", "/rewrite", dict(library="nope", programs=programs))[0] == 404
+    assert call(conn, "POST", "/rewrite", dict(programs="(f a a)"))[0] == 400
+    assert call(conn, "POST", "/rewrite", dict(library=["lib"], programs=programs))[0] == 400
+    assert call(conn, "POST", "/rewrite", dict(programs=[])) == (200, dict(rewritten=[]))
+    assert call(conn, "GET", "/libraries") == (200, dict(lib=2))
+    status, server_stats = call(conn, "GET", "/stats")
+    assert server_stats["requests"] == 11 and server_stats["errors"] == 1 and server_stats["batches"] < 10 # requests for unknown libraries or with bad json are turned away before reaching a batch
+    assert set(server_stats["latency_ms"]) == {"p50", "p90", "p99", "mean", "max"}
+    conn.close()
+    server.shutdown()
+    server.server_close()
+    # only a stale socket is cleared from the --unix path, not some other file
+    with tempfile.TemporaryDirectory() as tmp:
+        path = pathlib.Path(tmp) / "stitch.sock"
+        make_server(rewrite_server, unix=str(path)).server_close()
+        make_server(rewrite_server, unix=str(path)).server_close()
+        path.unlink()
+        path.write_text("keep me")
+        try:
+            make_server(rewrite_server, unix=str(path))
+            assert False, "Should have thrown an exception"
+        except FileExistsError:
+            pass
+        assert path.read_text() == "keep me"
+    # a batch that fails unexpectedly fails its requests rather than leaving them waiting forever
+    def broken_batch(batch):
+        raise ZeroDivisionError("broken")
+    rewrite_server.batchers["lib"].run_batch = broken_batch
+    try:
+        rewrite_server.rewrite(programs[:2])
+        assert False, "Should have thrown an exception"
+    except ZeroDivisionError:
+        pass
+    rewrite_server.close()
+    assert percentiles([3, 1, 2, 4]) == dict(p50=3, p90=4, p99=4, mean=2.5, max=4)
+
+    # rewriting on a process pool with the library loaded once per worker
+    with RewritePool(res_save.abstractions, processes=2, chunk_size=4) as pool:
+        assert pool.map(programs) == res_save.rewritten
+        assert list(pool.imap(iter(programs * 3))) == res_save.rewritten * 3
+        assert [len(chunk) for chunk in pool.imap_chunks([programs[:2], programs[2:]])] == [2, len(programs) - 2]
+    with tempfile.TemporaryDirectory() as tmp:
+        save_library(res_save.abstractions, pathlib.Path(tmp) / "lib")
+        with RewritePool(pathlib.Path(tmp) / "lib", processes=1) as pool:
+            assert pool.map(programs) == res_save.rewritten
+    with RewritePool([], processes=1) as pool:
+        assert pool.map(programs) == programs
+    with RewritePool(res_save.abstractions, processes=1) as pool:
+        try:
+            pool.map(["(f a"])
+            assert False, "Should have thrown an exception"
+        except StitchException:
+            pass
+
+    # type grammars reused across compress() calls
+    programs = ["(f (g a a) (g b b))", "(f (g c c) (g d d))", "(f (g a a) (g e e))"]
+    tdfa = {"S": {"f": ["T", "T"]}, "T": {"g": ["T", "T"], "a": [], "b": [], "c": [], "d": [], "e": []}}
+    grammar = TdfaGrammar.from_dict(tdfa, "S", ["S", "T"], ["T"])
+    assert TdfaGrammar.from_dict(json.loads(json.dumps(tdfa)), "S", ["S", "T"], ["T"]) is grammar
+    assert TdfaGrammar.from_dict(tdfa, "S", ["T"], ["T"]) is not grammar
+    res_tdfa = compress(programs, iterations=2, tdfa=grammar)
+    assert res_tdfa.abstractions[0].body == "(f (g #1 #1) (g #0 #0))" and res_tdfa.abstractions[0].tdfa_annotation == {"root_state": "S", "metavariable_states": ["T", "T"]}
+    assert hash(res_tdfa.abstractions[0]) == hash(pickle.loads(pickle.dumps(res_tdfa.abstractions[0])))
+    assert compress(programs, iterations=2, **grammar.compress_kwargs()).json["abstractions"] == res_tdfa.json["abstractions"]
+    assert compress(programs, iterations=2, tdfa=TdfaGrammar.from_dict(tdfa, "S", ["S"], ["T"])).abstractions[0].tdfa_annotation["root_state"] == "S"
+    with tempfile.TemporaryDirectory() as tmp:
+        (pathlib.Path(tmp) / "tdfa.json").write_text(json.dumps(tdfa))
+        assert TdfaGrammar.load(pathlib.Path(tmp) / "tdfa.json", "S", ["S", "T"], ["T"]) is grammar
+    # a different grammar left at a grammar's cache path is replaced rather than trusted, and the cache is private to the user
+    grammar_file = pathlib.Path(grammar.compress_kwargs()["tdfa_json_path"])
+    grammar_file.write_text(json.dumps({"S": {"f": ["S", "S"]}}))
+    assert json.loads(pathlib.Path(TdfaGrammar(tdfa, "S", ["S", "T"], ["T"]).compress_kwargs()["tdfa_json_path"]).read_text()) == tdfa
+    grammar_file.write_text(json.dumps({"S": {"f": ["S", "S"]}}))
+    assert json.loads(pathlib.Path(grammar.compress_kwargs()["tdfa_json_path"]).read_text()) == tdfa # checked on every use, not just the first
+    assert grammar_file.parent.stat().st_mode & 0o077 == 0
+    # a grammar keeps its own copy of the dict, and the caches can be emptied
+    changed = json.loads(json.dumps(tdfa))
+    copied = TdfaGrammar(changed, "S", ["S", "T"], ["T"])
+    changed["T"]["h"] = ["T"]
+    assert copied.tdfa == tdfa and json.loads(pathlib.Path(copied.compress_kwargs()["tdfa_json_path"]).read_text()) == tdfa
+    TdfaGrammar.clear_cache()
+    assert TdfaGrammar.from_dict(tdfa, "S", ["S", "T"], ["T"]) is not grammar
+    try:
+        TdfaGrammar(tdfa, "S", ["S", "U"], ["T"])
+        assert False, "Should have thrown an exception"
+    except ValueError:
+        pass
 
-# loading from a file
-with open('../data/cogsci/nuts-bolts.json','r') as f:
-    programs = json.load(f)
-res = compress(programs, iterations=3, max_arity=3)
-assert res.abstractions[0].body == '(T (repeat (T l (M 1 0 -0.5 (/ 0.5 (tan (/ pi #1))))) #1 (M 1 (/ (* 2 pi) #1) 0 0)) (M #0 0 0 0))'
-assert res.abstractions[1].body == '(repeat (T (T #2 (M 0.5 0 0 0)) (M 1 0 (* #1 (cos (/ pi 4))) (* #1 (sin (/ pi 4))))) #0 (M 1 (/ (* 2 pi) #0) 0 0))'
-assert res.abstractions[2].body == '(T (T c (M 2 0 0 0)) (M #0 0 0 0))'
-
-# dreamcoder format
-with open('../data/dc/origami/iteration_0_3.json','r') as f:
-    dreamcoder_json = json.load(f)
-kwargs = from_dreamcoder(dreamcoder_json)
-res = compress(**kwargs, iterations=3, max_arity=3)
-assert res.abstractions[0].body == '(if (empty? (cdr #0)) #2 (#1 (cdr #0)))'
-
-
-# StitchException: passing in an argument that doesn't actually exist
-try:
-    out_json = compress(programs, iterations=3, nonexistant_arg=213879)
-    assert False, "Should have thrown an exception"
-except StitchException as e:
-    pass
-
-# StitchException: malformed programs (or any other panic in the rust backend)
-bad_programs = ["(a a a"]
-try:
-    out_json = compress(bad_programs, iterations=3)
-    assert False, "Should have thrown an exception"
-except StitchException as e:
-    # print(e)
-    pass
-
-# TypeError: passing in an argument of the wrong type, so that conversion to strongly typed Rust fails
-bad_programs = 4
-try:
-    out_json = compress(bad_programs, iterations=3, loud_panic=True)
-    assert False, "Should have thrown an exception"
-except TypeError as e:
-    # print(e)
-    pass
-
-# 1x (default) weighting vs 2x weighting vs weighting the "g" programs more
-programs = ["(f a a)", "(f b b)", "(f c c)", "(g d d)", "(g e e)"]
-res = compress(programs, iterations=1)
-res2x = compress(programs, iterations=1, weights=[2. for _ in programs])
-res_uneven = compress(programs, iterations=1, weights=[1., 1., 1., 2., 2.])
-
-assert res.json["original_cost"] *2 == res2x.json["original_cost"]
-assert res.json["final_cost"] *2 == res2x.json["final_cost"]
-assert res.abstractions[0].body == res2x.abstractions[0].body == "(f #0 #0)"
-assert res_uneven.abstractions[0].body == "(g #0 #0)"
-
-# make sure compression ratio is as expected
-assert math.fabs(res_uneven.json["original_cost"]/res_uneven.json["final_cost"] - res_uneven.json["compression_ratio"]) < 0.00001
-
-# assert res.rewritten == ['(fn_0 a)', '(fn_0 b)']
-# assert res.abstractions[0].body == '(#0 #0 #0)'
-
-
-print("Passed all tests")
\ No newline at end of file
+    print("Passed all tests")
\ No newline at end of file